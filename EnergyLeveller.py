@@ -10,9 +10,77 @@ You are free to use, modify and distribute the code, though recognition of my ef
 from __future__ import print_function
 import sys
 import os.path
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+import glob
+import time
+import multiprocessing
+import argparse
+import functools
+import hashlib
+import shutil
+import operator
+import contextlib
+import gc
+import json
+import io
+import re
+import math
+import csv
+import collections
+import threading
+import struct
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+VERSION = "2.0"
+
+# numpy and matplotlib are imported on first use by _ImportNumpy() and _ImportMatplotlib(),
+# so reading and checking inputs does not pay for loading the plotting stack.
+np = None
+matplotlib = None
+plt = None
+LineCollection = None
+PolyCollection = None
+Line2D = None
+
+def _ImportNumpy():
+    global np
+    if np is None:
+        import numpy as np
+
+def _ImportMatplotlib():
+    global matplotlib, plt, LineCollection, PolyCollection, Line2D
+    _ImportNumpy()
+    if plt is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import LineCollection, PolyCollection
+        from matplotlib.lines import Line2D
+
+def _MatplotlibVersion():
+    """
+    The installed matplotlib version, found without importing it where possible.
+    """
+    if matplotlib is not None:
+        return matplotlib.__version__
+    try:
+        # Released matplotlib packages carry a generated _version.py, far quicker to read than importing
+        import importlib.util
+        spec = importlib.util.find_spec("matplotlib")
+        with open(os.path.join(spec.submodule_search_locations[0], "_version.py")) as f:
+            for line in f:
+                if line.startswith("version ="):
+                    return line.split("=", 1)[1].strip().strip("'\"")
+    except Exception:
+        pass
+    _ImportMatplotlib()
+    return matplotlib.__version__
 
 class Diagram:
     """
@@ -23,21 +91,38 @@ class Diagram:
     def __init__(self, width, height, fontSize, outputName, y_lims):
         self.width = width
         self.height = height
-        self.y_lims = y_lims
-        if y_lims is not None:
-            self.sorted_y_lims = sorted(y_lims) # Used to simplify bounds checking
-        else:
-            self.sorted_y_lims = None
+        self.fontSize = fontSize
+        self.SetEnergyRange(y_lims)
         self.outputName = outputName
+        self.outputFormats = []  # Also saved as these formats, under the output name with their extension
+        self.variants    = []    # Subsets of the diagram also drawn, see ParseVariant()
 
-        self.fig = plt.figure(figsize=(self.width, self.height))
-        self.ax = self.fig.add_subplot(111)
+        self.fig = None  # Made by Draw(), so inputs can be checked before any matplotlib work
+        self.ax = None
 
         self.statesList  = {}
+        self.links       = []    # (source, destination, colour) names, in input order
+        self.linksFrom   = {}    # source name -> list of its links, for states with any
+        self.linksChecked = False
         self.dashes      = [6.0,3.0] # ink, skip
         self.columns     = 0
         self.energyUnits = ""
         self.do_legend   = False
+        self.useCollections = False  # Batch lines into LineCollections, much faster for large diagrams
+        self.fastLayout  = False  # Work out axis limits and margins directly instead of asking matplotlib
+        self.avoidOverlaps = False  # Nudge labels and energy texts apart, see PlaceLabels()
+        self.marginsFitted = False
+        self.legendHandles = []
+        self.legendGuide = None  # Hidden stand-in for the collections, see DrawLegendGuide()
+        self.layout      = StateLayout()  # Position arrays, filled in by MakeLeftRightPoints()
+        self.profiler    = NO_PROFILER
+
+    def SetEnergyRange(self, y_lims):
+        self.y_lims = y_lims
+        if y_lims is not None:
+            self.sorted_y_lims = sorted(y_lims) # Used to simplify bounds checking
+        else:
+            self.sorted_y_lims = None
 
     def AddState(self, state):
         state.name = state.name.upper()
@@ -48,116 +133,879 @@ class Diagram:
             self.do_legend = True
         if state.name not in self.statesList:
             self.statesList[state.name] = state
+            self.layout.Add(state)
         else:
             print("ERROR: States must have unique names. State " + state.name + " is already in use!")
             raise ValueError("Non unique state names.")
 
+        if state.linksTo != "":
+            edges = []
+            for link in state.linksTo.split(','):
+                dest, _, color = link.partition(':')
+                if dest.strip() == "":
+                    continue    # e.g. a trailing comma, which has always been allowed
+                edge = (state.name, dest.strip(), color.strip() or 'BLACK')
+                edges.append(edge)
+                self.links.append(edge)
+            self.linksFrom[state.name] = edges
+        self.linksChecked = False
+
+    def AddLink(self, source, dest, color='BLACK'):
+        """
+        Links state source to dest, as if dest were in the source's links-to list.
+        """
+        edge = (source, dest, color)
+        self.links.append(edge)
+        self.linksFrom.setdefault(source, []).append(edge)
+        self.linksChecked = False
+
+    def Reachable(self, names):
+        """
+        The names of the given states and every state reachable from them by following links.
+        """
+        found = set(names)
+        pending = list(found)
+        while len(pending) > 0:
+            for _, dest, _ in self.linksFrom.get(pending.pop(), ()):
+                if dest not in found:
+                    found.add(dest)
+                    pending.append(dest)
+        return found
+
+    def LegendGroup(self, legends):
+        """
+        The names of the states making up the paths with the given legend entries: states
+        drawn in the colour of a state carrying one of the legends, and both ends of every
+        link drawn in that colour, which brings in the states the paths share.
+        """
+        colours = set(s.color.upper() for s in self.statesList.values() if s.legend in legends)
+        found = set(s.name for s in self.statesList.values() if s.color.upper() in colours)
+        for source, dest, color in self.links:
+            if color.upper() in colours:
+                found.add(source)
+                found.add(dest)
+        return found
+
+    def Variant(self, variant):
+        """
+        The subset of this diagram described by a variant from ParseVariant(), saved
+        under the output name with "-" and the variant's name added before the extension.
+        """
+        names = set(self.statesList)
+        if variant["legends"]:
+            known = set(s.legend for s in self.statesList.values())
+            missing = [l for l in variant["legends"] if l not in known]
+            if len(missing) > 0:
+                print("ERROR: Variant " + variant["name"] + " uses legend " + ", ".join(missing) + ", but no state has it.")
+                raise ValueError("Unknown legend in variant " + variant["name"])
+            names &= self.LegendGroup(variant["legends"])
+        if variant["sources"]:
+            missing = [n for n in variant["sources"] if n not in self.statesList]
+            if len(missing) > 0:
+                print("ERROR: Variant " + variant["name"] + " starts from " + ", ".join(missing) + ", but no state has that name.")
+                raise ValueError("Unknown state in variant " + variant["name"])
+            names &= self.Reachable(variant["sources"])
+        if len(names) == 0:
+            print("ERROR: Variant " + variant["name"] + " leaves no states to draw.")
+            raise ValueError("Empty variant " + variant["name"])
+        base, ext = os.path.splitext(self.outputName)
+        return self.Subset(names, base + "-" + variant["name"] + ext, variant["y_lims"] or self.y_lims)
+
+    def Subset(self, names, outputName, y_lims=None):
+        """
+        A new Diagram of just the named states and the links between them, drawn to outputName.
+        The states are copied but share their decoded images, and their positions are taken
+        from this diagram's layout rather than worked out again.
+        """
+        if self.layout.leftx is None:
+            self.MakeLeftRightPoints()
+        subset = Diagram(self.width, self.height, self.fontSize, outputName, y_lims)
+        subset.outputFormats = self.outputFormats
+        subset.energyUnits = self.energyUnits
+        subset.dashes = self.dashes
+        subset.profiler = self.profiler
+        indices = []
+        for state in self.layout.states:
+            if state.name in names:
+                copy = state.Copy()
+                copy.linksTo = ",".join(dest + ":" + color for _, dest, color in self.linksFrom.get(state.name, ())
+                    if dest in names)
+                subset.AddState(copy)
+                indices.append(state.layoutIndex)
+        subset.columns = self.columns
+        subset.CheckLinks()
+        layout = subset.layout
+        layout.leftx = self.layout.leftx[indices]
+        layout.lefty = self.layout.lefty[indices]
+        layout.rightx = self.layout.rightx[indices]
+        layout.righty = self.layout.righty[indices]
+        return subset
+
+    def CheckLinks(self):
+        """
+        Checks every link points at a known state. All unknown names are reported before raising.
+        """
+        unknown = 0
+        for source, dest, _ in self.links:
+            if source not in self.statesList:
+                # Only possible for links added with AddLink()
+                print("ERROR: A link is from " + source + ", but name: " + source + " is unknown.")
+                unknown += 1
+            if dest not in self.statesList:
+                print("ERROR: State " + source + " links to " + dest + ", but name: " + dest + " is unknown.")
+                unknown += 1
+        if unknown > 0:
+            raise ValueError("Unknown state names in links.")
+        self.linksChecked = True
+
+    def HashImages(self):
+        """
+        Fills in the image keys of states read without loading their images, see ReadInput().
+        """
+        for state in self.layout.states:
+            if state.imagePath is not None and state.imageKey is None:
+                state.imageKey = IMAGE_CACHE.Key(state.imagePath)
+
+    def LoadImages(self):
+        """
+        Decodes the images of states read without loading them, see ReadInput().
+        """
+        for state in self.layout.states:
+            if state.imagePath is not None and state.image is None:
+                with self.profiler.Phase("images"):
+                    state.imageKey, state.image = IMAGE_CACHE.Load(state.imagePath)
+                self.profiler.Count("images")
+
     def MakeLeftRightPoints(self):
+        # Timed apart, so the first use of numpy does not pass for slow layout
+        with self.profiler.Phase("import numpy"):
+            _ImportNumpy()
+        with self.profiler.Phase("layout"):
+            self.MakeLayout()
+
+    def MakeLayout(self):
+        _ImportNumpy()
         columnWidth = 1
 
-        for _, state in self.statesList.items():
-            state.leftPointx = state.column*columnWidth + state.column*columnWidth/2.0
-            state.leftPointy = state.energy
-            state.rightPointx = state.leftPointx + columnWidth
-            state.rightPointy = state.energy
+        layout = self.layout
+        n = len(layout.states)
+        energy = np.fromiter(map(operator.attrgetter("energy"), layout.states), dtype=float, count=n)
+        column = np.fromiter(map(operator.attrgetter("column"), layout.states), dtype=float, count=n)
+        layout.leftx = column*columnWidth + column*columnWidth/2.0
+        layout.lefty = energy
+        layout.rightx = layout.leftx + columnWidth
+        layout.righty = energy.copy()
+
+    def MakeFigure(self):
+        with self.profiler.Phase("import matplotlib"):
+            _ImportMatplotlib()
+        if self.fontSize is not None:
+            plt.rcParams.update({'font.size': self.fontSize})
+        self.fig = plt.figure(figsize=(self.width, self.height))
+        self.ax = self.fig.add_subplot(111)
+        self.marginsFitted = False
 
     def Draw(self):
+        # Kept out of the "draw" phase, which then times only drawing
+        with self.profiler.Phase("import matplotlib"):
+            _ImportMatplotlib()
+        with self.profiler.Phase("draw"):
+            self.DrawArtists()
+        self.Save()
+
+    def DrawArtists(self):
+        """
+        Draws the whole diagram onto a new figure, recording the artists belonging to
+        each state and link so Update() can later replace just the ones that change.
+        """
+        if not self.linksChecked:
+            self.CheckLinks()
+        self.LoadImages()
+        if self.layout.leftx is None:
+            self.MakeLeftRightPoints()
+        if self.fig is None:
+            with self.profiler.Phase("figure"):
+                self.MakeFigure()
+        layout = self.layout
+        profiler = self.profiler
+        self.stateArtists = dict((state.name, []) for state in layout.states)
+        self.linkArtists = {}
+        fast = self.fastLayout and len(layout.states) > 0
+        if fast:
+            with profiler.Phase("limits"):
+                frame = self.AutoLimits()
+
         self.ax.axhline(0.0,color='gray',linestyle=':')
 
 #   Draw the states
-        for key in self.statesList.keys():
-            state = self.statesList[key]
-            self.ax.plot([state.leftPointx, state.rightPointx], [state.leftPointy, state.rightPointy], c=state.color, lw=3, ls='-', label=state.legend)
+        with profiler.Phase("levels"):
+            if self.useCollections:
+                self.DrawLevelCollections()
+            else:
+                for i, state in enumerate(layout.states):
+                    self.DrawLevel(i, state)
 
 #   Draw their labels
-        offset = self.ax.get_ylim()
-        offset = offset[1]*0.01
-        for key in self.statesList.keys():
-            state = self.statesList[key]
-            y_point = state.leftPointy + state.labelOffset[1] + offset
-            if self.sorted_y_lims is None or (y_point >= self.sorted_y_lims[0] and y_point <= self.sorted_y_lims[1]):
-                self.ax.annotate(
-                    state.label,
-                    (state.leftPointx + state.labelOffset[0], y_point),
-                    color=state.labelColor,
-                    verticalalignment='bottom', annotation_clip=True)
-
-            y_point = state.leftPointy + state.textOffset[1] - offset
-            if state.show_energy and (self.sorted_y_lims is None or (y_point >= self.sorted_y_lims[0] and y_point <= self.sorted_y_lims[1])):
-                self.ax.annotate(
-                    "  " + str(state.energy),
-                    (state.leftPointx  + state.textOffset[0], y_point),
-                    color=state.labelColor,
-                    verticalalignment='top', annotation_clip=True)
+        with profiler.Phase("labels"):
+            offset = frame[1] if fast else self.ax.get_ylim()
+            self.labelShift = offset[1]*0.01
+            if self.avoidOverlaps:
+                with profiler.Phase("place labels"):
+                    self.PlaceLabels(frame if fast else (self.ax.get_xlim(), offset))
+            self.DrawLabels(np.arange(len(layout.states)))
 
         # Now xrange is set by other things, fit the images
         # This requires some conversion between data coordinates and axes coordinates
         # As we want to position and scale the image in data space, but preserve the aspect ratio
         # in axes space...
 
-        xlim = self.ax.get_xlim()
+        with profiler.Phase("draw images"):
+            self.imageFrame = frame if fast else (self.ax.get_xlim(), self.ax.get_ylim())
+            extents = []
+            for key in self.statesList.keys():
+                state = self.statesList[key]
+                if state.image is not None:
+                    extents.append(self.DrawImage(state))
+                    profiler.Count("images drawn")
+
+#   Draw the dashed lines connecting them
+        with profiler.Phase("links"):
+            if self.useCollections:
+                self.DrawLinkCollections()
+            else:
+                for link in self.links:
+                    self.DrawLink(link)
+
+        with profiler.Phase("legend"):
+            self.ax.set_ylabel(str(self.energyUnits))
+            if self.y_lims is not None:
+                self.ax.set_ylim(self.y_lims)
+            self.ax.set_xticks([])
+            self.DrawLegend()
+
+        if fast:
+            with profiler.Phase("margins"):
+                xlim, ylim = self.AutoLimits(extents)
+                self.ax.set_xlim(xlim)
+                if self.y_lims is None:
+                    self.ax.set_ylim(ylim)
+                self.FitMargins()
+
+        profiler.Count("states", len(layout.states))
+        profiler.Count("links", len(self.links))
+        profiler.Count("artists", len(self.ax.lines) + len(self.ax.collections) + len(self.ax.texts) + len(self.ax.images))
+
+    def DrawLevel(self, i, state):
+        layout = self.layout
+        line, = self.ax.plot([layout.leftx[i], layout.rightx[i]], [layout.lefty[i], layout.righty[i]], c=state.color, lw=3, ls='-', label=state.legend)
+        self.stateArtists[state.name].append(line)
+
+    def DrawLabels(self, indices):
+        """
+        Draws the label and energy text of the states at the given layout indices,
+        skipping any that fall outside the energy range.
+        """
+        layout = self.layout
+        offset = self.labelShift
+        labelOffset = layout.GatherPairs("labelOffset", indices)
+        textOffset = layout.GatherPairs("textOffset", indices)
+        label_x = layout.leftx[indices] + labelOffset[:, 0]
+        label_y = layout.lefty[indices] + labelOffset[:, 1] + offset
+        text_x = layout.leftx[indices] + textOffset[:, 0]
+        text_y = layout.lefty[indices] + textOffset[:, 1] - offset
+        if layout.labelNudge is not None:
+            label_y = label_y + layout.labelNudge[indices]
+            text_y = text_y + layout.textNudge[indices]
+        show_label = self.InEnergyRange(label_y)
+        show_text = self.InEnergyRange(text_y)
+        for j, i in enumerate(indices):
+            state = layout.states[i]
+            artists = self.stateArtists[state.name]
+            if show_label[j]:
+                artists.append(self.ax.annotate(
+                    state.label,
+                    (label_x[j], label_y[j]),
+                    color=state.labelColor,
+                    verticalalignment='bottom', annotation_clip=True))
+
+            if state.show_energy and show_text[j]:
+                artists.append(self.ax.annotate(
+                    "  " + str(state.energy),
+                    (text_x[j], text_y[j]),
+                    color=state.labelColor,
+                    verticalalignment='top', annotation_clip=True))
+
+    def DrawImage(self, state):
+        xlim, ylim = self.imageFrame
         x_range = xlim[1] - xlim[0]
-        ylim = self.ax.get_ylim()
         y_range = ylim[1] - xlim[0]
-        ax_aspect = x_range/y_range  # Save the current axis aspect ratio for later restoration
-
-        for key in self.statesList.keys():
-            state = self.statesList[key]
-            if state.image is not None:
-                aspect_ratio = state.image.shape[1]/state.image.shape[0]  # Width/Height
-
-                # Determine desired image characteristics in axes coordinates
-                axes_left = (state.leftPointx - xlim[0])/x_range
-                axes_right = (state.rightPointx - xlim[0])/x_range
-                axes_width = axes_right - axes_left
-                axes_bottom = (state.leftPointy - ylim[0])/y_range
-                axes_height = axes_width/aspect_ratio
-                axes_top = axes_bottom + axes_height
-
-                # Now use them to find data coordinates
-                data_left = state.leftPointx
-                data_right = state.rightPointx*state.imageScale
-                data_bottom = state.leftPointy
-                data_top = (ylim[0] + axes_top*y_range)*state.imageScale
-
-                self.ax.imshow(state.image,
-                    extent=(
-                        data_left + state.imageOffset[0],
-                        data_right + state.imageOffset[0],
-                        data_bottom + state.imageOffset[1],
-                        data_top + state.imageOffset[1]),
-                    aspect=aspect_ratio,
-                    interpolation='lanczos')
 
-#   Draw the dashed lines connecting them
-        for key in self.statesList.keys():
-            state = self.statesList[key]
-            if state.linksTo != "":
-                for link in state.linksTo.split(','):
-                    link = link.strip()
-                    raw = link.split(':')
-                    dest = raw[0]
-                    if len(raw) > 1:
-                        color = raw[1]
-                    else:
-                        color = 'BLACK'
-                    if dest in self.statesList:
-                        self.ax.plot([state.rightPointx, self.statesList[dest].leftPointx], [state.rightPointy, self.statesList[dest].leftPointy],
-                            c=color, ls='--', lw=1)
-                    else:
-                        print("Name: " + dest + " is unknown.")
+        aspect_ratio = state.image.shape[1]/state.image.shape[0]  # Width/Height
+
+        # Determine desired image characteristics in axes coordinates
+        axes_left = (state.leftPointx - xlim[0])/x_range
+        axes_right = (state.rightPointx - xlim[0])/x_range
+        axes_width = axes_right - axes_left
+        axes_bottom = (state.leftPointy - ylim[0])/y_range
+        axes_height = axes_width/aspect_ratio
+        axes_top = axes_bottom + axes_height
+
+        # Now use them to find data coordinates
+        data_left = state.leftPointx
+        data_right = state.rightPointx*state.imageScale
+        data_bottom = state.leftPointy
+        data_top = (ylim[0] + axes_top*y_range)*state.imageScale
+
+        image = IMAGE_CACHE.Fit(state.imageKey, state.image,
+            abs(data_right - data_left)/x_range*self.width*self.ImageDpi(),
+            abs(data_top - data_bottom)/y_range*self.height*self.ImageDpi())
+
+        extent = (
+            data_left + state.imageOffset[0],
+            data_right + state.imageOffset[0],
+            data_bottom + state.imageOffset[1],
+            data_top + state.imageOffset[1])
+        self.stateArtists[state.name].append(self.ax.imshow(image,
+            extent=extent,
+            aspect=aspect_ratio,
+            interpolation='lanczos'))
+        return extent
+
+    def DrawLink(self, link):
+        source, dest, color = link
+        state = self.statesList[source]
+        dest = self.statesList[dest]
+        line, = self.ax.plot([state.rightPointx, dest.leftPointx], [state.rightPointy, dest.leftPointy],
+            c=color, ls='--', lw=1)
+        self.linkArtists.setdefault(link, []).append(line)
+
+    def DrawLegend(self, loc="best"):
+        legend = self.ax.get_legend()
+        if legend is not None:
+            legend.remove()
+        if self.do_legend:
+            if self.useCollections:
+                self.DrawLegendGuide()
+                self.ax.legend(handles=self.legendHandles, loc=loc)
+            else:
+                # Listed in state order, so states redrawn by Update() keep their place
+                self.ax.legend(handles=[self.stateArtists[state.name][0]
+                    for state in self.layout.states if state.legend is not None], loc=loc)
+
+    def Save(self, target=None, format=None):
+        """
+        Saves the drawn figure to every output file, or only to target (a file name,
+        binary stream or PdfPages) when given. format overrides the one implied by the name.
+        """
+        if not self.marginsFitted:
+            with self.profiler.Phase("tight_layout"):
+                self.fig.tight_layout()
+        with self.profiler.Phase("savefig"):
+            if target is not None:
+                self.fig.savefig(target, format=format)
+            else:
+                SaveFigure(self.fig, self.OutputNames())
+
+    def OutputNames(self):
+        """
+        The output file, followed by one of the same name for each extra output format.
+        """
+        names = [self.outputName]
+        base = os.path.splitext(self.outputName)[0]
+        for format in self.outputFormats:
+            name = base + "." + format
+            if name not in names:
+                names.append(name)
+        return names
+
+    def Extent(self):
+        """
+        The data range covered by the state lines, which sets the automatic axis limits.
+        """
+        layout = self.layout
+        if layout.leftx is None or len(layout.states) == 0:
+            return None
+        return (layout.leftx.min(), layout.rightx.max(), layout.lefty.min(), layout.lefty.max())
+
+    def Update(self, new):
+        """
+        Brings this drawn diagram in line with new, a freshly read and laid out version of
+        the same input, replacing only the artists of states and links that changed.
+        Returns False, leaving everything untouched, when the whole figure must be redrawn:
+        a global option such as width, height, font size or energy range changed, the
+        data extent (and so the axis limits) moved, or a changed state has an image.
+        """
+        if self.fig is None or self.useCollections or new.useCollections or self.avoidOverlaps:
+            return False
+        if (self.width, self.height, self.fontSize, self.y_lims) != (new.width, new.height, new.fontSize, new.y_lims):
+            return False
+        if self.Extent() != new.Extent():
+            return False
+
+        changed = set()
+        for name, state in new.statesList.items():
+            if name not in self.statesList or self.statesList[name].Fingerprint() != state.Fingerprint():
+                changed.add(name)
+        for name in self.statesList:
+            if name not in new.statesList:
+                changed.add(name)
+        for name in changed:
+            for states in (self.statesList, new.statesList):
+                if name in states and states[name].image is not None:
+                    return False
+        if not new.linksChecked:
+            new.CheckLinks()
+
+        newLinks = set(new.links)
+        stale = [link for link in self.linkArtists
+            if link[0] in changed or link[1] in changed or link not in newLinks]
+        oldLinks = set(self.links)
+        fresh = []
+        for link in new.links:
+            if link[0] in changed or link[1] in changed or link not in oldLinks:
+                fresh.append(link)
+
+        for name in changed:
+            for artist in self.stateArtists.pop(name, []):
+                artist.remove()
+        for link in stale:
+            for artist in self.linkArtists.pop(link):
+                artist.remove()
+
+        self.statesList = new.statesList
+        self.links = new.links
+        self.linksFrom = new.linksFrom
+        self.linksChecked = True
+        self.layout = new.layout
+        self.do_legend = new.do_legend
+        self.columns = new.columns
+        self.outputName = new.outputName
+        self.outputFormats = new.outputFormats
+        self.energyUnits = new.energyUnits
+
+        for name in changed:
+            if name in self.statesList:
+                state = self.statesList[name]
+                self.stateArtists[name] = []
+                self.DrawLevel(state.layoutIndex, state)
+                self.DrawLabels(np.array([state.layoutIndex]))
+        for link in fresh:
+            self.DrawLink(link)
 
         self.ax.set_ylabel(str(self.energyUnits))
         if self.y_lims is not None:
             self.ax.set_ylim(self.y_lims)
-        self.ax.set_xticks([])
-        if self.do_legend:
-            self.ax.legend()
+        self.DrawLegend()
+        if self.marginsFitted:
+            # Changed labels can need other margins, fitted again from where a new figure starts
+            params = matplotlib.rcParams
+            self.fig.subplots_adjust(left=params['figure.subplot.left'], right=params['figure.subplot.right'],
+                bottom=params['figure.subplot.bottom'], top=params['figure.subplot.top'])
+            self.FitMargins()
+        self.lastUpdate = (len(changed), len(fresh) + len(stale))
+        return True
+
+    def PlaceLabels(self, frame):
+        """
+        Nudges state labels up and energy texts down, just far enough that none overlap,
+        storing the shifts in layout.labelNudge and layout.textNudge. Text sizes are estimated
+        from the font size and the axis limits in frame, without measuring them. Texts given
+        an explicit offset in the input never move, the others are placed around them.
+        """
+        layout = self.layout
+        n = len(layout.states)
+        size = matplotlib.rcParams['font.size']
+        (x0, x1), (y0, y1) = frame
+        params = self.fig.subplotpars
+        # Data units per point
+        xScale = abs(x1 - x0)/(self.width*72.0*(params.right - params.left))
+        yScale = abs(y1 - y0)/(self.height*72.0*(params.top - params.bottom))
+        shift = self.labelShift
+
+        fixed = []
+        labels = []
+        texts = []
+        for i, state in enumerate(layout.states):
+            x = layout.leftx[i]
+            y = layout.lefty[i]
+            if state.label != "":
+                w, h = EstimateTextSize(state.label, size)
+                ox, oy = state.labelOffset
+                box = (x + ox, x + ox + w*xScale, y + oy + shift, y + oy + shift + h*yScale)
+                (labels if ox == 0 and oy == 0 else fixed).append((i, box))
+            if state.show_energy:
+                w, h = EstimateTextSize("  " + str(state.energy), size)
+                ox, oy = state.textOffset
+                box = (x + ox, x + ox + w*xScale, y + oy - shift - h*yScale, y + oy - shift)
+                (texts if ox == 0 and oy == 0 else fixed).append((i, box))
+
+        layout.labelNudge = np.zeros(n)
+        layout.textNudge = np.zeros(n)
+        boxes = [box for _, box in fixed + labels + texts]
+        if len(boxes) == 0:
+            return
+        index = LabelIndex(np.median([b[1] - b[0] for b in boxes]), np.median([b[3] - b[2] for b in boxes]))
+        gap = 0.1*size*yScale
+        for _, box in fixed:
+            index.Add(box)
+        # Energy texts from the top down, then labels from the bottom up, so each only
+        # has to move away from the texts already placed
+        for i, box in sorted(texts, key=lambda t: -t[1][3]):
+            layout.textNudge[i] = index.Place(box, -1, gap)[3] - box[3]
+        index.Settle()
+        for i, box in sorted(labels, key=lambda t: t[1][2]):
+            layout.labelNudge[i] = index.Place(box, 1, gap)[2] - box[2]
+        self.profiler.Count("labels nudged", int(np.count_nonzero(layout.labelNudge) + np.count_nonzero(layout.textNudge)))
+
+    def AutoLimits(self, images=()):
+        """
+        The axis limits matplotlib's autoscaling would pick for the state lines, the zero
+        line and the given image extents, worked out from the layout arrays without drawing.
+        """
+        layout = self.layout
+        xs = [layout.leftx.min(), layout.rightx.max()]
+        ys = [layout.lefty.min(), layout.lefty.max(), 0.0]
+        for left, right, bottom, top in images:
+            xs += [left, right]
+            ys += [bottom, top]
+        # Images, unlike lines, stop the margin being added beyond their edges
+        stickyX = [x for extent in images for x in extent[:2]]
+        stickyY = [y for extent in images for y in extent[2:]]
+        return (_AutoscaleRange(min(xs), max(xs), stickyX, matplotlib.rcParams['axes.xmargin']),
+                _AutoscaleRange(min(ys), max(ys), stickyY, matplotlib.rcParams['axes.ymargin']))
+
+    def FitMargins(self):
+        """
+        Sets the figure margins so the axis decorations, the legend and the labels fit, as
+        tight_layout() would. Rather than measuring every label in the diagram, the reach of
+        each is estimated with EstimateTextSize() and only the few reaching furthest out on
+        each side are measured. Axes with a fixed aspect ratio, as images give them, shrink
+        to fit in ways this does not follow, so they are left to tight_layout() when saving.
+        """
+        if self.ax.get_aspect() != 'auto':
+            return
+        renderer = self.fig.canvas.get_renderer()
+        boxes = [self.ax.bbox, self.ax.yaxis.get_tightbbox(renderer)]
+        legend = self.ax.get_legend()
+        if legend is not None:
+            boxes.append(legend.get_window_extent(renderer))
+
+        texts = [artist for artists in self.stateArtists.values() for artist in artists
+            if isinstance(artist, matplotlib.text.Text)]
+        if len(texts) > 0:
+            anchors = self.ax.transData.transform([text.get_position() for text in texts])
+            # Labels are annotations, only drawn while their point is inside the axes
+            axes = self.ax.bbox
+            shown = ((anchors[:, 0] >= axes.x0) & (anchors[:, 0] <= axes.x1) &
+                     (anchors[:, 1] >= axes.y0) & (anchors[:, 1] <= axes.y1))
+            scale = self.fig.dpi/72.0
+            reach = np.empty((len(texts), 4))   # How far each gets past the left, bottom, right and top
+            for i, text in enumerate(texts):
+                w, h = EstimateTextSize(text.get_text(), text.get_fontsize())
+                x0 = anchors[i, 0] - w*scale*TEXT_ANCHORS[text.get_horizontalalignment()]
+                y0 = anchors[i, 1] - h*scale*TEXT_ANCHORS[text.get_verticalalignment()]
+                reach[i] = (-x0, -y0, x0 + w*scale, y0 + h*scale)
+            reach[~shown] = -np.inf
+            # The estimates are rough, so measure a few of the furthest on each side
+            furthest = set()
+            for side in range(4):
+                furthest.update(int(i) for i in np.argsort(reach[:, side])[-FIT_MARGIN_TEXTS:] if shown[i])
+            for i in sorted(furthest):
+                boxes.append(texts[i].get_window_extent(renderer))
+        bbox = matplotlib.transforms.Bbox.union([b for b in boxes if b is not None])
+
+        figure = self.fig.bbox
+        axes = self.ax.bbox
+        pad = 1.08*matplotlib.rcParams['font.size']/72.0*self.fig.dpi
+        left = (pad + axes.x0 - bbox.x0)/figure.width
+        right = 1 - (pad + bbox.x1 - axes.x1)/figure.width
+        bottom = (pad + axes.y0 - bbox.y0)/figure.height
+        top = 1 - (pad + bbox.y1 - axes.y1)/figure.height
+        # Where nothing could fit, e.g. a legend taller than the figure, tight_layout()
+        # leaves the margins alone, and so does this
+        if left < right and bottom < top:
+            self.fig.subplots_adjust(left=left, right=right, bottom=bottom, top=top)
+        self.marginsFitted = True
+
+    def InEnergyRange(self, y):
+        """
+        Returns a boolean array, True where y lies within the energy range (always if none is set).
+        """
+        if self.sorted_y_lims is None:
+            return np.ones(len(y), dtype=bool)
+        return (y >= self.sorted_y_lims[0]) & (y <= self.sorted_y_lims[1])
+
+    def RevealSteps(self, reveal="paths"):
+        """
+        Splits the states into the groups an animation reveals one at a time, in input order:
+        one state per step for "states", or all the states drawn in one colour for "paths".
+        """
+        if reveal == "states":
+            return [[state] for state in self.layout.states]
+        if reveal != "paths":
+            print("ERROR: Unknown reveal '" + str(reveal) + "', expected states or paths.")
+            raise ValueError("Unknown reveal " + str(reveal))
+        groups = collections.OrderedDict()
+        for state in self.layout.states:
+            groups.setdefault(state.color.upper(), []).append(state)
+        return list(groups.values())
+
+    def DrawFrames(self, reveal="paths"):
+        """
+        Draws the diagram as a step by step reveal, yielding each frame as an RGBA array.
+        The axes, zero line and images are drawn once as the background, then each frame
+        draws only the states revealed by its step, and the links they complete, onto the Agg
+        buffer left by the frame before, so a frame costs what it adds. The legend is pinned
+        where the whole diagram puts it and drawn over each frame.
+        Lines are drawn one by one for this, never as collections.
+        """
+        self.useCollections = False
+        if self.fig is None:
+            with self.profiler.Phase("figure"):
+                self.MakeFigure()
+        with self.profiler.Phase("draw"):
+            self.DrawArtists()
+        if not self.marginsFitted:
+            with self.profiler.Phase("tight_layout"):
+                self.fig.tight_layout()
+
+        steps = self.RevealSteps(reveal)
+        linksInto = {}
+        for link in self.links:
+            linksInto.setdefault(link[1], []).append(link)
+        legend = self.ax.get_legend()
+        if legend is not None:
+            # loc="best" would be worked out again at each frame from the artists shown so
+            # far, moving the legend about, so pin it where the whole diagram puts it
+            corner = legend.get_window_extent(self.fig.canvas.get_renderer()).p0
+            self.DrawLegend(loc=tuple(self.ax.transAxes.inverted().transform(corner)))
+            legend = self.ax.get_legend()
+        hidden = {}
+        for name, artists in self.stateArtists.items():
+            hidden[name] = [a for a in artists if not isinstance(a, matplotlib.image.AxesImage)]
+        for artists in list(hidden.values()) + list(self.linkArtists.values()):
+            for artist in artists:
+                artist.set_visible(False)
+        if legend is not None:
+            legend.set_visible(False)
+        with self.profiler.Phase("background"):
+            self.fig.canvas.draw()
+        if legend is not None:
+            # The legend goes over each frame's lines, so the buffer beneath it is kept and
+            # restored before the next step is drawn: its frame is translucent, and drawing
+            # it over itself would fade what lies behind it a little more every frame
+            legend.set_visible(True)
+            box = legend.get_window_extent()    # Widened to whole pixels, with its antialiased edges
+            box = matplotlib.transforms.Bbox([np.floor(box.p0) - 2, np.ceil(box.p1) + 2])
+            legendBox = matplotlib.transforms.Bbox.intersection(box, self.fig.bbox)
+
+        shown = set()
+        beneath = None
+        for step in steps:
+            with self.profiler.Phase("frames"):
+                artists = []
+                for state in step:
+                    shown.add(state.name)
+                    artists.extend(hidden[state.name])
+                completed = set()
+                for state in step:
+                    for link in self.linksFrom.get(state.name, []) + linksInto.get(state.name, []):
+                        if link[0] in shown and link[1] in shown and link not in completed:
+                            completed.add(link)
+                            artists.extend(self.linkArtists.get(link, ()))
+                if beneath is not None:
+                    self.fig.canvas.restore_region(beneath)
+                for artist in artists:
+                    artist.set_visible(True)
+                    self.ax.draw_artist(artist)
+                if legend is not None:
+                    beneath = self.fig.canvas.copy_from_bbox(legendBox)
+                    self.ax.draw_artist(legend)
+                frame = np.array(self.fig.canvas.buffer_rgba())
+            self.profiler.Count("frames")
+            yield frame
+
+    def ImageDpi(self):
+        """
+        Resolution images will be rasterised at when saved, used to decide how far they can be downsampled.
+        """
+        dpi = matplotlib.rcParams['savefig.dpi']
+        if dpi == 'figure':
+            return self.fig.dpi
+        return max(dpi, self.fig.dpi)
+
+    def IterLinks(self):
+        """
+        Yields (state, destination state, colour) for every link in the diagram.
+        """
+        for source, dest, color in self.links:
+            yield self.statesList[source], self.statesList[dest], color
+
+    def DrawLevelCollections(self):
+        """
+        Draws all the state lines as one LineCollection per colour and legend entry,
+        rather than one Line2D per state.
+        """
+        layout = self.layout
+        groups = {}
+        order = []
+        for i, state in enumerate(layout.states):
+            group = (state.color, state.legend)
+            if group not in groups:
+                groups[group] = []
+                order.append(group)
+            groups[group].append(i)
 
-        self.fig.tight_layout()
-        self.fig.savefig(self.outputName)
+        segments = np.stack((layout.leftx, layout.lefty, layout.rightx, layout.righty), axis=-1).reshape(-1, 2, 2)
+        for group in order:
+            color, legend = group
+            self.ax.add_collection(LineCollection(segments[groups[group]], colors=color, linewidths=3, linestyles='-',
+                capstyle=matplotlib.rcParams['lines.solid_capstyle']))
+        # Proxy artists so the legend entries look exactly like plotted state lines, one per
+        # state with a legend as when they are plotted one by one, duplicates included
+        self.legendHandles = [Line2D([], [], c=state.color, lw=3, ls='-', label=state.legend)
+            for state in layout.states if state.legend is not None]
+        self.ax.autoscale_view()
+
+    def DrawLinkCollections(self):
+        """
+        Draws all the dashed links as one LineCollection per colour.
+        """
+        layout = self.layout
+        groups = {}
+        order = []
+        for source, dest, color in self.links:
+            if color not in groups:
+                groups[color] = ([], [])
+                order.append(color)
+            groups[color][0].append(self.statesList[source].layoutIndex)
+            groups[color][1].append(self.statesList[dest].layoutIndex)
+
+        for color in order:
+            sources, dests = groups[color]
+            segments = np.stack((layout.rightx[sources], layout.righty[sources],
+                layout.leftx[dests], layout.lefty[dests]), axis=-1).reshape(-1, 2, 2)
+            self.ax.add_collection(LineCollection(segments, colors=color, linewidths=1, linestyles='--'),
+                autolim=False)
+        # Links end on state lines so add nothing to the limits, but as with plotting them one by
+        # one the view must be rescaled, or imshow() leaves it fitted to the last image drawn
+        self.ax.autoscale_view()
+
+    def DrawLegendGuide(self):
+        """
+        loc="best" steers the legend clear of each Line2D but not of LineCollections, so give it
+        the collections' segments again as one hidden PolyCollection, whose paths it checks one
+        by one. The legend then goes where it would with the lines plotted one by one.
+        """
+        if self.legendGuide is not None:
+            self.legendGuide.remove()
+            self.legendGuide = None
+        segments = [segment for collection in self.ax.collections
+            if isinstance(collection, LineCollection) for segment in collection.get_segments()]
+        if len(segments) > 0:
+            self.legendGuide = PolyCollection(segments, closed=False, visible=False)
+            self.ax.add_collection(self.legendGuide, autolim=False)
+
+    def Close(self):
+        """
+        Releases the figure so long running processes (e.g. batch workers) do not accumulate them.
+        """
+        if self.fig is not None:
+            plt.close(self.fig)
+            self.fig = None
+            self.ax = None
+        # The artists refer back to the figure, so drop them too
+        self.stateArtists = {}
+        self.linkArtists = {}
+        self.legendHandles = []
+        self.legendGuide = None
+
+def _AutoscaleRange(low, high, sticky, margin):
+    """
+    Pads the data range low to high by margin of its width on each side, the way matplotlib
+    autoscales a linear axis, without passing any of the sticky values inside the range.
+    """
+    if high - low <= 1e-15*max(abs(low), abs(high)):
+        # A single value, widened the same way as matplotlib does
+        if low == 0.0:
+            low, high = -0.05, 0.05
+        else:
+            low, high = low - 0.05*abs(low), high + 0.05*abs(high)
+    sticky = np.sort(sticky)
+    tol = 1e-5*max(abs(low), abs(high), abs(high - low))
+    below = sticky.searchsorted(low + tol) - 1
+    above = sticky.searchsorted(high - tol)
+    delta = (high - low)*margin
+    padded = (low - delta, high + delta)
+    if below != -1:
+        padded = (max(padded[0], sticky[below]), padded[1])
+    if above != len(sticky):
+        padded = (padded[0], min(padded[1], sticky[above]))
+    return padded
+
+def SaveFigure(fig, names):
+    """
+    Saves a drawn figure to each file in names. Where fork is available every name after the
+    first is saved by a child process holding a copy-on-write copy of the figure, so the
+    backends for several formats run in parallel after a single layout and draw. Inside a
+    worker process (batch or server) the names are saved in turn instead, as the workers
+    already keep every CPU busy.
+    """
+    if (len(names) == 1 or not hasattr(os, "fork") or multiprocessing.cpu_count() == 1 or
+            multiprocessing.current_process().name != "MainProcess"):
+        for name in names:
+            fig.savefig(name)
+        return
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    children = {}
+    failed = []
+    try:
+        for name in names[1:]:
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    fig.savefig(name)
+                    code = 0
+                except BaseException as e:
+                    print("ERROR: Could not save {:}. {:}: {:}".format(name, type(e).__name__, e))
+                finally:
+                    sys.stdout.flush()
+                    os._exit(code)
+            children[pid] = name
+        fig.savefig(names[0])
+    finally:
+        # Waited for even when saving the first name fails, or each child is left a zombie
+        for pid, name in children.items():
+            if os.waitpid(pid, 0)[1] != 0:
+                failed.append(name)
+    if len(failed) > 0:
+        raise IOError("Failed to save " + ", ".join(failed))
+
+def _LayoutView(array, local):
+    """
+    Property reading a state position from its diagram's StateLayout arrays,
+    or from the state itself when no layout has been made.
+    """
+    def get(self):
+        if self.layout is not None and self.layout.leftx is not None:
+            return getattr(self.layout, array)[self.layoutIndex]
+        return getattr(self, local)
+    def set(self, value):
+        if self.layout is not None and self.layout.leftx is not None:
+            getattr(self.layout, array)[self.layoutIndex] = value
+        else:
+            setattr(self, local, value)
+    return property(get, set)
+
+class State(object):
+    __slots__ = ("name", "color", "labelColor", "linksTo", "label", "legend", "energy",
+        "normalisedPosition", "column", "labelOffset", "textOffset", "imageOffset",
+        "imageScale", "image", "imagePath", "imageKey", "show_energy",
+        "layout", "layoutIndex", "_leftPointx", "_leftPointy", "_rightPointx", "_rightPointy")
 
-class State:
     def __init__(self):
         self.name        = ""
         self.color       = "k"
@@ -168,6 +1016,8 @@ class State:
         self.energy      = 0.0
         self.normalisedPosition = 0.0
         self.column      = 1
+        self.layout      = None
+        self.layoutIndex = 0
         self.leftPointx  = 0
         self.leftPointy  = 0
         self.rightPointx = 0
@@ -177,190 +1027,1263 @@ class State:
         self.imageOffset = (0,0)
         self.imageScale = 1.0
         self.image = None
+        self.imagePath = None
+        self.imageKey = None    # Content hash of the image file, shared by states using the same image
         self.show_energy = True
 
+    def Copy(self):
+        """
+        A copy of the state, not yet part of any diagram, sharing its image array.
+        """
+        copy = State()
+        for name in State.__slots__:
+            if name not in ("layout", "layoutIndex") and not name.startswith("_"):
+                setattr(copy, name, getattr(self, name))
+        return copy
+
+    def Fingerprint(self):
+        """
+        Everything about the state that affects how it is drawn, for spotting changes.
+        """
+        return (self.name, self.color, self.labelColor, self.label, self.legend, self.energy,
+            self.column, self.labelOffset, self.textOffset, self.show_energy,
+            self.imageKey, self.imageOffset, self.imageScale, self.linksTo)
+
+    leftPointx  = _LayoutView("leftx", "_leftPointx")
+    leftPointy  = _LayoutView("lefty", "_leftPointy")
+    rightPointx = _LayoutView("rightx", "_rightPointx")
+    rightPointy = _LayoutView("righty", "_rightPointy")
+
+class StateLayout(object):
+    """
+    Array storage for the positions of a diagram's states, in the order they were added.
+    Each state knows its index, and its leftPointx etc. are views onto these arrays
+    once MakeLeftRightPoints() has filled them. Adding a state clears the positions.
+    """
+    def __init__(self):
+        self.states = []
+        self.Clear()
+
+    def Add(self, state):
+        state.layout = self
+        state.layoutIndex = len(self.states)
+        self.states.append(state)
+        self.Clear()
+
+    def Clear(self):
+        self.leftx = None
+        self.lefty = None
+        self.rightx = None
+        self.righty = None
+        self.labelNudge = None  # Vertical shifts from Diagram.PlaceLabels(), when used
+        self.textNudge = None
+
+    def GatherPairs(self, attribute, indices=None):
+        """
+        Returns an n x 2 array of an (x, y) attribute such as labelOffset, for every state or those at indices.
+        """
+        states = self.states
+        if indices is not None:
+            states = [states[i] for i in indices]
+        return np.array(list(map(operator.attrgetter(attribute), states)), dtype=float).reshape(len(states), 2)
+
+######################################################################################################
+#           Label placement
+######################################################################################################
+
+def EstimateTextSize(text, size):
+    """
+    Rough (width, height) in points of text drawn at font size, without a renderer.
+    Mathtext commands count as one character, and sub and superscripts as smaller ones.
+    """
+    scripts = 0
+    if '$' in text:
+        scripts = sum(len(g) for g in re.findall(r'[_^]\{([^}]*)\}', text)) + len(re.findall(r'[_^][^{]', text))
+        text = re.sub(r'\\[a-zA-Z]+', 'x', text)
+        text = re.sub(r'[$_^{}\\]', '', text)
+    width = (len(text) - 0.3*scripts)*0.6*size
+    height = (1.5 if scripts > 0 else 1.2)*size
+    return width, height
+
+# Where the anchor point of a text sits across its box, by horizontal or vertical alignment
+TEXT_ANCHORS = {"left": 0.0, "center": 0.5, "right": 1.0,
+                "bottom": 0.0, "baseline": 0.2, "center_baseline": 0.5, "top": 1.0}
+FIT_MARGIN_TEXTS = 8    # Texts measured on each side by Diagram.FitMargins()
+
+class LabelIndex(object):
+    """
+    Spatial index for placing text boxes (x0, x1, y0, y1) clear of each other. Obstacles are
+    kept in a uniform grid, each listed in every cell it touches, so only the cells a box
+    covers are searched for overlaps. Boxes placed in one direction are instead tracked by
+    the furthest edge reached in each narrow column, so a box joining a stack jumps straight
+    past it rather than climbing one box at a time. Placing n boxes in order along that
+    direction then costs O(n log n) for the sort rather than O(n^2) pairwise checks.
+    """
+    def __init__(self, cellWidth, cellHeight):
+        self.cellWidth = max(cellWidth, 1e-12)
+        self.cellHeight = max(cellHeight, 1e-12)
+        self.columnWidth = self.cellWidth/4.0
+        self.cells = {}
+        self.edges = {}     # Column -> furthest edge of the boxes placed since Settle()
+        self.placed = []
+
+    def Cells(self, box):
+        x0, x1, y0, y1 = box
+        for i in range(int(math.floor(x0/self.cellWidth)), int(math.floor(x1/self.cellWidth)) + 1):
+            for j in range(int(math.floor(y0/self.cellHeight)), int(math.floor(y1/self.cellHeight)) + 1):
+                yield (i, j)
+
+    def Add(self, box):
+        for cell in self.Cells(box):
+            self.cells.setdefault(cell, []).append(box)
+
+    def Overlapping(self, box):
+        x0, x1, y0, y1 = box
+        found = []
+        for cell in self.Cells(box):
+            for other in self.cells.get(cell, ()):
+                if other[0] < x1 and x0 < other[1] and other[2] < y1 and y0 < other[3]:
+                    found.append(other)
+        return found
+
+    def Place(self, box, direction, gap):
+        """
+        Moves box up (direction 1) or down (-1) until it is clear of the obstacles and of
+        the boxes already placed, which must have started lower (higher) than it does.
+        Returns the moved box.
+        """
+        columns = range(int(math.floor(box[0]/self.columnWidth)), int(math.floor(box[1]/self.columnWidth)) + 1)
+        reached = [self.edges[c] for c in columns if c in self.edges]
+        while True:
+            move = 0.0
+            if len(reached) > 0:
+                if direction > 0:
+                    move = max(max(reached) + gap - box[2], 0.0)
+                else:
+                    move = min(min(reached) - gap - box[3], 0.0)
+            others = self.Overlapping((box[0], box[1], box[2] + move, box[3] + move))
+            if len(others) > 0:
+                if direction > 0:
+                    move = max(o[3] for o in others) + gap - box[2]
+                else:
+                    move = min(o[2] for o in others) - gap - box[3]
+            box = (box[0], box[1], box[2] + move, box[3] + move)
+            if len(others) == 0:
+                break
+            reached = [box[2] - gap if direction > 0 else box[3] + gap]
+
+        edge = box[3] if direction > 0 else box[2]
+        for c in columns:
+            if c not in self.edges or (edge - self.edges[c])*direction > 0:
+                self.edges[c] = edge
+        self.placed.append(box)
+        return box
+
+    def Settle(self):
+        """
+        Makes the boxes placed so far obstacles for those placed afterwards, in either direction.
+        """
+        for box in self.placed:
+            self.Add(box)
+        self.placed = []
+        self.edges = {}
+
+######################################################################################################
+#           Profiling
+######################################################################################################
+
+class Profiler:
+    """
+    Records the time spent in each phase of reading and drawing a diagram, along with
+    counts of what was drawn and the peak memory of the process. Phases may nest, each
+    recording its own inclusive time, e.g. "read" includes "images".
+
+        profiler = Profiler()
+        diagram = ReadInput("example.inp", profiler=profiler)
+        RenderDiagram(diagram)
+        json.dumps(profiler.Report())
+
+    A disabled profiler (the default, NO_PROFILER) does nothing.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = {}
+        self.order = []
+        self.counts = {}
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def Phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        if name not in self.phases:
+            self.phases[name] = 0.0
+            self.order.append(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.time() - start
+
+    def Count(self, name, n=1):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def Report(self):
+        return {
+            "version":      VERSION,
+            "total":        time.time() - self.start,
+            "phases":       [{"name": name, "seconds": self.phases[name]} for name in self.order],
+            "counts":       dict(self.counts),
+            "peakMemoryMB": PeakMemory(),
+        }
+
+NO_PROFILER = Profiler(enabled=False)
+
+def PeakMemory():
+    """
+    Peak resident memory of this process in MB, or None where it cannot be found.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak/(1024.0*1024.0)     # bytes on macOS, kB elsewhere
+    return peak/1024.0
+
+def WriteProfile(filename, reports):
+    """
+    Writes profile reports to filename as JSON. Several reports (from a batch) are listed slowest first.
+    """
+    if isinstance(reports, list):
+        reports = sorted(reports, key=lambda r: r["total"], reverse=True)
+    with open(filename, 'w') as out:
+        json.dump(reports, out, indent=2)
+    print("Profile written to " + filename)
+
+######################################################################################################
+#           Image cache
+######################################################################################################
+
+class ImageCache:
+    """
+    Decodes each image file once and shares the array between every state that uses it.
+    Images are keyed on a hash of their contents, so the same picture under different
+    paths is also only held once. Downsampled copies made for drawing are cached too.
+    Once the arrays held pass maxBytes, the least recently used images are dropped along
+    with their downsampled copies, so long running processes do not grow without limit.
+    """
+    def __init__(self, maxBytes=256*1024*1024):
+        self.maxBytes = maxBytes
+        self.files = {}     # path -> (modification time, size, key)
+        self.images = {}    # key -> full resolution array
+        self.fitted = {}    # (key, factor) -> downsampled array
+        self.used = collections.OrderedDict()   # key -> bytes held for it, least recently used first
+        self.size = 0
+
+    def Key(self, path):
+        """
+        Returns the content hash of the image file at path, without decoding it.
+        """
+        stat = os.stat(path)
+        known = self.files.get(path)
+        if known is not None and known[0] == stat.st_mtime and known[1] == stat.st_size:
+            return known[2]
+        with open(path, 'rb') as f:
+            key = hashlib.sha1(f.read()).hexdigest()
+        self.files[path] = (stat.st_mtime, stat.st_size, key)
+        return key
+
+    def Load(self, path):
+        """
+        Returns (key, array) for the image file at path.
+        """
+        key = self.Key(path)
+        image = self.images.get(key)
+        if image is None:
+            _ImportMatplotlib()
+            image = self.images[key] = plt.imread(path)
+            self.Use(key, image.nbytes)
+        else:
+            self.Use(key)
+        return key, image
+
+    def Fit(self, key, image, width, height):
+        """
+        Returns image downsampled by the largest whole factor that still leaves at least
+        width x height pixels, averaging over blocks of pixels.
+        """
+        factor = int(min(image.shape[1]/max(width, 1.0), image.shape[0]/max(height, 1.0)))
+        if factor < 2:
+            return image
+        if key is not None and (key, factor) in self.fitted:
+            self.Use(key)
+            return self.fitted[(key, factor)]
+
+        rows = (image.shape[0]//factor)*factor
+        cols = (image.shape[1]//factor)*factor
+        blocks = image[:rows, :cols].reshape((rows//factor, factor, cols//factor, factor) + image.shape[2:])
+        fitted = blocks.mean(axis=(1, 3)).astype(image.dtype)
+        if key is not None:
+            self.fitted[(key, factor)] = fitted
+            self.Use(key, fitted.nbytes)
+        return fitted
+
+    def Use(self, key, added=0):
+        """
+        Marks key as the most recently used, adding any newly held bytes, and evicts the
+        least recently used keys while over maxBytes. The key just used is always kept.
+        """
+        self.used[key] = self.used.pop(key, 0) + added
+        self.size += added
+        while self.size > self.maxBytes and len(self.used) > 1:
+            self.Forget(next(iter(self.used)))
+
+    def Forget(self, key):
+        self.size -= self.used.pop(key, 0)
+        self.images.pop(key, None)
+        for fit in [fit for fit in self.fitted if fit[0] == key]:
+            del self.fitted[fit]
+        for path in [path for path, known in self.files.items() if known[2] == key]:
+            del self.files[path]
+
+    def Clear(self):
+        self.files.clear()
+        self.images.clear()
+        self.fitted.clear()
+        self.used.clear()
+        self.size = 0
+
+IMAGE_CACHE = ImageCache()
+
 ######################################################################################################
 #           Input reading block
 ######################################################################################################
 
-def ReadInput(filename):
+def NormaliseKey(key):
+    """
+    Reduces the many accepted spellings of an input key to one lookup form,
+    e.g. "Text Colour", "text-color" and "TEXTCOLOUR" all become "TEXTCOLOUR".
+    """
+    key = key.upper()
+    for separator in (" ", "-", "_", "\t"):
+        key = key.replace(separator, "")
+    return key.replace("COLOR", "COLOUR")
+
+def _ReadPair(value, what, lc, line):
     try:
-        inp = open(filename,'r')
-    except:
-        print("Error opening file. File: " + filename + " may not exist.")
-        raise SystemExit("Could not open Input file: {:}".format(filename))
+        raw = value.split(',')
+        return (float(raw[0]), float(raw[1]))
+    except (ValueError, IndexError):
+        print("ERROR: Could not read real number for " + what + " on line " + str(lc)+ ":\n\t"+line)
+        return None
+
+#   State block keys. Each handler is called as handler(state, value, lc, line)
+
+def _SplitEquals(handler, value):
+    """
+    The value a state line with more than one "=" has always had: a label keeps them all,
+    spaced as " = ", energy and image take the last part, and every other key the first.
+    """
+    parts = value.split("=")
+    if handler is _StateLabel:
+        return parts[0].strip() + "".join(" = " + part for part in parts[1:])
+    if handler is _StateEnergy or handler is _StateImage:
+        return parts[-1].strip()
+    return parts[0].strip()
+
+def _StateName(state, value, lc, line):
+    state.name = value.upper()
+
+def _StateColor(state, value, lc, line):
+    state.color = value
+
+def _StateLabel(state, value, lc, line):
+    state.label = value
 
-    stateBlock = False
-    statesList = []
-    width = 0
-    height = 0
-    fontSize = 8
-    energyUnits = ""
-    y_lims = None
-    lc = 0
-    for line in inp:
-        lc += 1
-        line = line.strip()
-        if (len(line) > 0 and line.strip()[0] != "#"):
-            if (stateBlock):
-                if (line.strip()[0] == "{"):
+def _StateLabelColor(state, value, lc, line):
+    state.labelColor = value
+
+def _StateLinksTo(state, value, lc, line):
+    state.linksTo = value.upper()
+
+def _StateColumn(state, value, lc, line):
+    try:
+        state.column = int(value)-1
+    except ValueError:
+        print("ERROR: Could not read integer for column number on line " + str(lc)+ ":\n\t"+line)
+
+def _StateEnergy(state, value, lc, line):
+    try:
+        state.energy = float(value)
+    except ValueError:
+        print("ERROR: Could not read real number for energy on line " + str(lc)+ ":\n\t"+line)
+
+def _StateLabelOffset(state, value, lc, line):
+    pair = _ReadPair(value, "label offset", lc, line)
+    if pair is not None:
+        state.labelOffset = pair
+
+def _StateTextOffset(state, value, lc, line):
+    pair = _ReadPair(value, "text offset", lc, line)
+    if pair is not None:
+        state.textOffset = pair
+
+def _StateLegend(state, value, lc, line):
+    state.legend = value
+
+def _StateImage(state, value, lc, line):
+    # Only checked here, InputParser decodes the image when the state is complete
+    if not os.path.isfile(value):
+        raise IOError("Failed to find image on line {:}".format(lc))
+    state.imagePath = value
+
+def _CheckImagePath(value, lc, line):
+    """
+    Refuses an image path that is absolute or climbs out with "..", for inputs from
+    untrusted sources such as the render server. Checked before the file is looked
+    for, so the error says nothing about which files exist.
+    """
+    parts = re.split(r"[\\/]", value)
+    if os.path.isabs(value) or os.path.splitdrive(value)[0] != "" or ".." in parts:
+        print("ERROR: Image paths must be relative and stay within the working directory, on line " + str(lc) + ":\n\t" + line)
+        raise IOError("Image path not allowed on line {:}".format(lc))
+
+def _StateImageOffset(state, value, lc, line):
+    pair = _ReadPair(value, "image offset", lc, line)
+    if pair is not None:
+        state.imageOffset = pair
+
+def _StateImageScale(state, value, lc, line):
+    try:
+        scale = float(value)
+        if scale < 0.1:
+            print("image scale cannot be < 0.1, setting to 0.1/")
+        state.imageScale = max(scale, 0.1)
+    except ValueError:
+        print("ERROR: Could not read real number for image scale on line " + str(lc)+ ":\n\t"+line)
+
+def _StateHideEnergy(state, value, lc, line):
+    state.show_energy = False
+
+STATE_KEYS = {
+    "NAME":        _StateName,
+    "TEXTCOLOUR":  _StateColor,
+    "LABEL":       _StateLabel,
+    "LABELCOLOUR": _StateLabelColor,
+    "LINKSTO":     _StateLinksTo,
+    "COLUMN":      _StateColumn,
+    "ENERGY":      _StateEnergy,
+    "LABELOFFSET": _StateLabelOffset,
+    "TEXTOFFSET":  _StateTextOffset,
+    "LEGEND":      _StateLegend,
+    "IMAGE":       _StateImage,
+    "IMAGEOFFSET": _StateImageOffset,
+    "IMAGESCALE":  _StateImageScale,
+    "HIDEENERGY":  _StateHideEnergy,
+}
+
+# Keys matched loosely, by containing all of the given words, checked in order when no exact match is found
+STATE_KEYWORDS = [
+    (("IMAGE", "OFFSET"), _StateImageOffset),
+    (("IMAGE", "SCALE"), _StateImageScale),
+    (("HIDE", "ENERGY"), _StateHideEnergy),
+]
+
+# State keys that need no value
+STATE_FLAGS = set([_StateHideEnergy])
+
+#   Global option keys. Each handler is called as handler(options, value, lc, line)
+
+# File extensions matplotlib can save to
+OUTPUT_FORMATS = ("eps", "jpeg", "jpg", "pdf", "pgf", "png", "ps", "raw", "rgba", "svg", "svgz", "tif", "tiff", "webp")
+
+def _OptionWidth(options, value, lc, line):
+    try:
+        options["width"] = int(value)
+    except ValueError:
+        print("ERROR: Could not read integer for diagram width on line " + str(lc)+ ":\n\t"+line)
+
+def _OptionHeight(options, value, lc, line):
+    try:
+        options["height"] = int(value)
+    except ValueError:
+        print("ERROR: Could not read integer for diagram height on line " + str(lc)+ ":\n\t"+line)
+
+def _OptionOutput(options, value, lc, line):
+    if os.path.splitext(value)[1][1:].lower() not in OUTPUT_FORMATS:
+        print("WARNING: Output will be .pdf. Adding this to output file.\nFile will be saved as "+value + ".pdf")
+        options["outputName"] = value + ".pdf"
+    else:
+        options["outputName"] = value
+
+def _OptionOutputFormats(options, value, lc, line):
+    formats = []
+    for format in value.replace(',', ' ').split():
+        format = format.lstrip('.').lower()
+        if format in OUTPUT_FORMATS:
+            formats.append(format)
+        else:
+            print("WARNING: Skipping unknown output format '" + format + "' on line " + str(lc) + ":\n\t" + line)
+    options["outputFormats"] = formats
+
+def _OptionVariant(options, value, lc, line):
+    try:
+        options["variants"].append(ParseVariant(value))
+    except ValueError:
+        print("Skipping the variant on line " + str(lc) + ":\n\t" + line)
+
+def _OptionEnergyUnits(options, value, lc, line):
+    options["energyUnits"] = value
+
+def _OptionFontSize(options, value, lc, line):
+    try:
+        options["fontSize"] = int(value)
+    except ValueError:
+        print("ERROR: Could not read integer for font size on line " + str(lc)+ ":\n\t"+line)
+        print("Default will be used...")
+
+def _OptionEnergyRange(options, value, lc, line):
+    try:
+        y_lims = [float(l) for l in value.split(',')]
+        assert len(y_lims) == 2, "Must have two comma separated numbers for range."
+        options["y_lims"] = y_lims
+    except ValueError:
+        print("ERROR: Could not read floats for energy range on line " + str(lc)+ ":\n\t"+line)
+        print("e.g: ENERGY RANGE = -1, 2")
+        print("Automatic range will be used...")
+
+OPTION_KEYS = {
+    "WIDTH":       _OptionWidth,
+    "HEIGHT":      _OptionHeight,
+    "OUTPUTFILE":  _OptionOutput,
+    "OUTPUT":      _OptionOutput,
+    "OUTPUTFORMATS": _OptionOutputFormats,
+    "FORMATS":     _OptionOutputFormats,
+    "ENERGYUNITS": _OptionEnergyUnits,
+    "FONTSIZE":    _OptionFontSize,
+    "VARIANT":     _OptionVariant,
+    "ENERGYRANGE": _OptionEnergyRange,
+}
+
+OPTION_KEYWORDS = [
+    (("ENERGY", "RANGE"), _OptionEnergyRange),
+]
+
+def _FindHandler(key, table, keywords):
+    handler = table.get(key)
+    if handler is None:
+        for words, candidate in keywords:
+            if all(word in key for word in words):
+                return candidate
+    return handler
+
+class InputParser:
+    """
+    Reads input line by line, dispatching each key through the tables above.
+    Global options are collected in the options dict, and Parse() yields each State
+    as its block closes so very large inputs never need to be held as text or in a list.
+    """
+    def __init__(self, loadImages=True, profiler=NO_PROFILER, basePath=None, restrictImages=False):
+        self.loadImages = loadImages
+        self.profiler = profiler
+        self.basePath = basePath    # Relative image paths are taken from here, else the working directory
+        self.restrictImages = restrictImages    # Refuse image paths leading outside of that directory
+        self.options = {
+            "width":       0,
+            "height":      0,
+            "fontSize":    None,    # matplotlib's default
+            "energyUnits": "",
+            "y_lims":      None,
+            "outputName":  "",
+            "outputFormats": [],
+            "variants":    [],
+        }
+        self.stateCount = 0
+        self.stateHandlers = {}  # Raw key as written -> handler, so each spelling is normalised only once
+
+    def Parse(self, lines):
+        state = None
+        lc = 0
+        handlers = self.stateHandlers
+        for line in lines:
+            lc += 1
+            line = line.strip()
+            if len(line) == 0 or line[0] == "#":
+                continue
+
+            if state is not None:
+                if line[0] == "}":
+                    yield self.FinishState(state)
+                    state = None
+                    continue
+                if line[0] == "{":
                     print("Unexpected opening '{' within state block on line " + str(lc) + ".\nPossible forgotten closing '}'.")
                     raise ValueError("ERROR: Unexpected { on line " + str(lc))
-                if (line.strip()[0] == "}"):
-                    stateBlock = False
+
+                raw = line.split('=', 1)
+                try:
+                    handler = handlers[raw[0]]
+                except KeyError:
+                    handler = _FindHandler(NormaliseKey(raw[0]), STATE_KEYS, STATE_KEYWORDS)
+                    handlers[raw[0]] = handler
+                if len(raw) == 2 and handler is not None:
+                    value = raw[1].strip()
+                    if "=" in value:
+                        value = _SplitEquals(handler, value)
+                    if handler is _StateImage and self.restrictImages:
+                        _CheckImagePath(value, lc, line)
+                    if handler is _StateImage and self.basePath is not None:
+                        value = os.path.join(self.basePath, value)
+                    handler(state, value, lc, line)
+                elif handler in STATE_FLAGS:
+                    handler(state, "", lc, line)
                 else:
-                    raw = line.split('=')
+                    print("Ignoring unrecognised line " + str(lc) + ":\n\t"+line)
+            elif line[0] == "{":
+                state = State()     # we have entered a state block
+            elif line[0] == "}":
+                print("WARNING: Not expecting closing } on line: " + str(lc))
+            else:
+                self.ReadOptionLine(line, lc)
 
-                    raw[0] = raw[0].upper().strip()
-                    
-                    try:
-                        raw[1] = raw[1].strip()
-                    except IndexError:
-                        pass
-
-                    if (raw[0] == "NAME"):
-                        statesList[-1].name = raw[1].upper()
-                    elif (raw[0] == "TEXTCOLOR" or raw[0] == "TEXTCOLOUR" or raw[0] == "TEXT-COLOUR" or raw[0] == "TEXT-COLOR" or raw[0] == "TEXT COLOUR" or raw[0] == "TEXT COLOR"):
-                        statesList[-1].color = raw[1]
-                    elif (raw[0] == "LABEL"):
-                        statesList[-1].label = ""
-                        for i in range(1, len(raw)):
-                            statesList[-1].label += raw[i]
-                            if i < len(raw)-1:
-                                statesList[-1].label += " = "
-                    elif (raw[0] == "LABELCOLOR" or raw[0] == "LABELCOLOUR"):
-                        statesList[-1].labelColor = raw[1]
-                    elif (raw[0] == "LINKSTO" or raw[0] == "LINKS TO"):
-                        statesList[-1].linksTo = raw[1].upper()
-                    elif (raw[0] == "COLUMN"):
-                        try:
-                            statesList[-1].column = int(raw[1])-1
-                        except ValueError:
-                            print("ERROR: Could not read integer for column number on line " + str(lc)+ ":\n\t"+line)
-                    elif (raw[0] == "ENERGY"):
-                        try:
-                            statesList[-1].energy = float(raw[-1])
-                        except ValueError:
-                            print("ERROR: Could not read real number for energy on line " + str(lc)+ ":\n\t"+line)
-                    elif (raw[0] == "LABELOFFSET" or raw[0] == "LABEL OFFSET" or raw[0] == "LABEL-OFFSET"):
-                        raw[1] = raw[1].split(',')
-                        try:
-                            tx = float(raw[1][0])
-                            ty = float(raw[1][1])
-                            statesList[-1].labelOffset = (tx, ty)
-                        except ValueError:
-                            print("ERROR: Could not read real number for label offset on line " + str(lc)+ ":\n\t"+line)
-                    elif (raw[0] == "TEXTOFFSET" or raw[0] == "TEXT OFFSET" or raw[0] == "TEXT-OFFSET"):
-                        raw[1] = raw[1].split(',')
-                        try:
-                            tx = float(raw[1][0])
-                            ty = float(raw[1][1])
-                            statesList[-1].textOffset = (tx, ty)
-                        except ValueError:
-                            print("ERROR: Could not read real number for text offset on line " + str(lc)+ ":\n\t"+line)
-                    elif raw[0] == "LEGEND":
-                        statesList[-1].legend = raw[1]
-                    elif raw[0] == "IMAGE":
-                        try:
-                            statesList[-1].image = plt.imread(raw[-1])
-                        except IOError:
-                            raise IOError("Failed to find image on line {:}".format(lc))
-                    elif "IMAGE" in raw[0] and "OFFSET" in raw[0]:
-                        raw[1] = raw[1].split(',')
-                        try:
-                            tx = float(raw[1][0])
-                            ty = float(raw[1][1])
-                            statesList[-1].imageOffset = (tx, ty)
-                        except ValueError:
-                            print("ERROR: Could not read real number for image offset on line " + str(lc)+ ":\n\t"+line)
-                    elif "IMAGE" in raw[0] and "SCALE" in raw[0]:
-                        try:
-                            scale = float(raw[1])
-                            if scale < 0.1:
-                                print("image scale cannot be < 0.1, setting to 0.1/")
-                            statesList[-1].imageScale = max(scale, 0.1)
-                        except ValueError:
-                            print("ERROR: Could not read real number for image scale on line " + str(lc)+ ":\n\t"+line)
-                    elif "HIDE" in raw[0] and "ENERGY" in raw[0]:
-                        statesList[-1].show_energy = False
-                    else:
-                        print("Ignoring unrecognised line " + str(lc) + ":\n\t"+line)
-            elif (line.strip()[0] == "{"):
-                statesList.append(State())
-                stateBlock = True   # we have entered a state block
+        if state is not None:
+            print("WARNING: Final closing '}' is missing.")
+            yield self.FinishState(state)
 
-            elif (line.strip()[0] == "}"):
-                print("WARNING: Not expecting closing } on line: " + str(lc))
+    def FinishState(self, state):
+        self.stateCount += 1
+        if self.loadImages and state.imagePath is not None:
+            with self.profiler.Phase("images"):
+                state.imageKey, state.image = IMAGE_CACHE.Load(state.imagePath)
+            self.profiler.Count("images")
+        return state
 
-            else:
-                """
-                READING GLOBAL OPTIONS
-                """
-                raw = line.split('=')
-                if (len(raw) != 2):
-                    print("Ignoring unrecognised line " + str(lc) + ":\n\t"+line)
-                else:
-                    raw[0] = raw[0].upper().strip()
-                    raw[1] = raw[1].strip().lstrip()
-                    if (raw[0] == "WIDTH"):
-                        try:
-                            width = int(raw[1])
-                        except ValueError:
-                            print("ERROR: Could not read integer for diagram width on line " + str(lc)+ ":\n\t"+line)
-                    elif (raw[0] == "HEIGHT"):
-                        try:
-                            height = int(raw[1])
-                        except ValueError:
-                            print("ERROR: Could not read integer for diagram height on line " + str(lc)+ ":\n\t"+line)
-                    elif (raw[0] == "OUTPUT-FILE" or raw[0] == "OUTPUT"):
-                        raw[1] = raw[1].lstrip()
-                        if ( not raw[1].endswith('.pdf')):
-                            print("WARNING: Output will be .pdf. Adding this to output file.\nFile will be saved as "+raw[1] + ".pdf")
-                            outName = raw[1] + ".pdf"
-                        else:
-                            outName = raw[1]
-                    elif (raw[0] == "ENERGY-UNITS" or raw[0] == "ENERGYUNITS" or raw[0] == "ENERGY UNITS"):
-                        energyUnits = raw[1]
-                    elif (raw[0] == "FONT-SIZE" or raw[0] == "FONTSIZE" or raw[0] == "FONT SIZE"):
-                        try:
-                            fontSize = int(raw[1])
-                            plt.rcParams.update({'font.size': fontSize})
-                        except ValueError:
-                            print("ERROR: Could not read integer for font size on line " + str(lc)+ ":\n\t"+line)
-                            print("Default will be used...")
-                    elif "ENERGY" in raw[0] and "RANGE" in raw[0]:
-                        try:
-                            y_lims = [float(l) for l in raw[1].split(',')]
-                            assert len(y_lims) == 2, "Must have two comma separated numbers for range."
-                        except ValueError:
-                            print("ERROR: Could not read floats for energy range on line " + str(lc)+ ":\n\t"+line)
-                            print("e.g: ENERGY RANGE = -1, 2")
-                            print("Automatic range will be used...")
-                    else:
-                        print("WARNING: Skipping unknown line " + str(lc) + ":\n\t" + line)
-    if stateBlock:
-        print("WARNING: Final closing '}' is missing.")
-    if height == 0:
-        print("ERROR: Image height not set! e.g.:\nheight = 500")
-        raise ValueError("Height not set")
-    if width == 0:
-        print("ERROR: Image width not set! e.g.:\nwidth = 500")
-        raise ValueError("Width not set")
-    if outName == "":
-        print("ERROR: output file name not set! e.g.:\n output-file = example.pdf")
-        raise ValueError("Output name not set")
-
-    outDiagram = Diagram(width, height, fontSize, outName, y_lims)
-    outDiagram.energyUnits = energyUnits
+    def ReadOptionLine(self, line, lc):
+        raw = line.split('=')
+        if (len(raw) != 2):
+            print("Ignoring unrecognised line " + str(lc) + ":\n\t"+line)
+            return
+        handler = _FindHandler(NormaliseKey(raw[0]), OPTION_KEYS, OPTION_KEYWORDS)
+        if handler is None:
+            print("WARNING: Skipping unknown line " + str(lc) + ":\n\t" + line)
+            return
+        handler(self.options, raw[1].strip(), lc, line)
+
+    def SetDiagramOptions(self, diagram):
+        options = self.options
+        diagram.width = options["width"]
+        diagram.height = options["height"]
+        diagram.fontSize = options["fontSize"]
+        diagram.outputName = options["outputName"]
+        diagram.outputFormats = options["outputFormats"]
+        diagram.variants = options["variants"]
+        diagram.energyUnits = options["energyUnits"]
+        diagram.SetEnergyRange(options["y_lims"])
+
+    def CheckOptions(self, requireOutput=True):
+        if self.options["height"] == 0:
+            print("ERROR: Image height not set! e.g.:\nheight = 500")
+            raise ValueError("Height not set")
+        if self.options["width"] == 0:
+            print("ERROR: Image width not set! e.g.:\nwidth = 500")
+            raise ValueError("Width not set")
+        if requireOutput and self.options["outputName"] == "":
+            print("ERROR: output file name not set! e.g.:\n output-file = example.pdf")
+            raise ValueError("Output name not set")
+
+def ReadInput(filename, loadImages=True, profiler=NO_PROFILER, parseCache=False):
+    """
+    Reads an input file, or a CSV or JSON network table (see ReadNetwork()), into a Diagram.
+    With loadImages False, image files are only checked to exist, which keeps matplotlib
+    from being imported.
+    The profiler, if given, times this and every later phase of drawing the diagram.
+    With parseCache set the parsed diagram is kept in a sidecar file next to the input and
+    read back from there while the input and its images are unchanged, see LoadParsed().
+    """
+    if parseCache and loadImages:
+        with profiler.Phase("parse cache"):
+            diagram = LoadParsed(filename, profiler)
+        profiler.Count("parse cache hits" if diagram is not None else "parse cache misses")
+        if diagram is None:
+            diagram = ReadInput(filename, loadImages, profiler)
+            with profiler.Phase("parse cache"):
+                StoreParsed(filename, diagram)
+        return diagram
+
+    try:
+        if os.path.splitext(filename)[1].lower() in NETWORK_EXTENSIONS:
+            inp = open(filename, 'r', newline='')   # The csv module reads line breaks in quoted cells itself
+        else:
+            inp = open(filename,'r')
+    except:
+        print("Error opening file. File: " + filename + " may not exist.")
+        raise SystemExit("Could not open Input file: {:}".format(filename))
+
+    with inp:
+        if IsLinksTable(filename):
+            print("ERROR: " + filename + " is the links table of a network, read the network "
+                + filename[:-len(LINKS_TABLE_SUFFIX)] + ".csv instead.")
+            raise ValueError("Links table given as input: " + filename)
+        if os.path.splitext(filename)[1].lower() in NETWORK_EXTENSIONS:
+            return ReadNetwork(inp, filename, loadImages, profiler)
+        return ReadStream(inp, loadImages, profiler)
+
+def ReadString(text, loadImages=True, profiler=NO_PROFILER, requireOutput=False, basePath=None, restrictImages=False):
+    """
+    Reads input held in a string into a Diagram, see ReadStream().
+    """
+    if isinstance(text, bytes):
+        text = text.decode("utf-8")
+    return ReadStream(text.splitlines(), loadImages, profiler, requireOutput, basePath, restrictImages)
+
+def ReadStream(lines, loadImages=True, profiler=NO_PROFILER, requireOutput=True, basePath=None, restrictImages=False):
+    """
+    Reads input from any iterable of lines, such as an open file or a StringIO, into a Diagram.
+    With requireOutput False the input need not name an output file, for diagrams rendered
+    to memory with RenderBytes(). Relative image paths are looked up in basePath when given.
+    With restrictImages set, absolute image paths and ones using ".." are refused.
+    """
+    parser = InputParser(loadImages, profiler, basePath, restrictImages)
+    outDiagram = Diagram(0, 0, parser.options["fontSize"], "", None)
+    outDiagram.profiler = profiler
     maxColumn = 0
-    for state in statesList:
-        outDiagram.AddState(state)
-        if (state.column > maxColumn):
-            maxColumn = state.column
+    with profiler.Phase("read"):
+        for state in parser.Parse(lines):
+            outDiagram.AddState(state)
+            if (state.column > maxColumn):
+                maxColumn = state.column
+    parser.CheckOptions(requireOutput)
+    parser.SetDiagramOptions(outDiagram)
     outDiagram.columns = maxColumn + 1
+    with profiler.Phase("check links"):
+        outDiagram.CheckLinks()
 
     return outDiagram
 
+######################################################################################################
+#           Reaction network tables
+######################################################################################################
+
+NETWORK_EXTENSIONS = (".csv", ".json")
+LINKS_TABLE_SUFFIX = ".links.csv"
+
+def IsLinksTable(filename):
+    """
+    Whether filename is the links table read alongside a network's states, not an input itself.
+    """
+    return filename.lower().endswith(LINKS_TABLE_SUFFIX)
+
+# Column names accepted in tables on top of the input file's own state keys
+TABLE_STATE_KEYS = {
+    "ID":     _StateName,
+    "STATE":  _StateName,
+    "COLOUR": _StateColor,
+    "LINKS":  _StateLinksTo,
+}
+
+TABLE_LINK_KEYS = {
+    "SOURCE": "source", "FROM": "source",
+    "TARGET": "target", "TO": "target", "DEST": "target", "DESTINATION": "target",
+    "COLOUR": "colour",
+}
+
+TRUE_VALUES = set(["1", "Y", "YES", "TRUE", "ON", "X"])
+
+def _TableValue(value):
+    """
+    A table cell as the text the input file handlers expect.
+    """
+    if isinstance(value, bool):
+        return "yes" if value else ""
+    if isinstance(value, (list, tuple)):
+        return ",".join(str(v) for v in value)
+    if value is None:
+        return ""
+    return str(value).strip()
+
+def _CsvRows(stream):
+    """
+    Yields (line number, [(heading, cell), ...], line) for each row of CSV with a heading row.
+    Blank rows and rows starting with # are skipped. The stream should be opened with
+    newline='', so line breaks in quoted cells are read whole, and they are given as \n.
+    """
+    reader = csv.reader(stream)
+    header = None
+    for row in reader:
+        row = [cell.replace("\r\n", "\n").replace("\r", "\n") for cell in row]
+        if len(row) == 0 or row[0].lstrip().startswith("#"):
+            continue
+        if header is None:
+            header = [h.strip() for h in row]
+            continue
+        yield reader.line_num, list(zip(header, row)), ",".join(row)
+
+def _JsonRows(rows, what):
+    if not isinstance(rows, list):
+        print("ERROR: Expected a list of {:}s, got: {:}".format(what, json.dumps(rows)))
+        raise ValueError("Malformed {:} table".format(what))
+    for i, row in enumerate(rows):
+        if isinstance(row, dict):
+            yield i + 1, list(row.items()), json.dumps(row)
+        else:
+            print("ERROR: Expected an object for {:} {:}, got: {:}".format(what, i + 1, json.dumps(row)))
+            raise ValueError("Malformed {:} table".format(what))
+
+def ReadNetwork(stream, filename, loadImages=True, profiler=NO_PROFILER):
+    """
+    Reads a reaction network from a CSV or JSON table straight into a Diagram.
+
+    A CSV file has a heading row naming its columns, with any of the input file's state keys
+    (name, energy, label, column, links-to, ...). Links can also be listed in a separate
+    file alongside it, named as the input with .links.csv in place of .csv, with source,
+    target and optional colour columns. A JSON file holds an object of global options
+    with "states" and optional "links" lists of objects using the same keys.
+    The width and height default to 8 and the output file to the input's name as a PDF.
+    States without a column are placed by AssignColumns().
+    """
+    base, ext = os.path.splitext(filename)
+    parser = InputParser(loadImages, profiler)
+    parser.options.update({"width": 8, "height": 8, "outputName": base + ".pdf"})
+    diagram = Diagram(0, 0, None, "", None)
+    diagram.profiler = profiler
+
+    with profiler.Phase("read"):
+        if ext.lower() == ".json":
+            data = json.load(stream)
+            if isinstance(data, list):
+                data = {"states": data}
+            elif not isinstance(data, dict):
+                print("ERROR: Expected an object of options or a list of states, got: " + json.dumps(data))
+                raise ValueError("Malformed network table")
+            for key, value in data.items():
+                if key in ("states", "links"):
+                    continue
+                handler = _FindHandler(NormaliseKey(key), OPTION_KEYS, OPTION_KEYWORDS)
+                if handler is None:
+                    print("WARNING: Skipping unknown option: " + key)
+                elif handler is _OptionVariant and isinstance(value, list):
+                    for spec in value:
+                        handler(parser.options, _TableValue(spec), 0, key + " = " + json.dumps(spec))
+                else:
+                    handler(parser.options, _TableValue(value), 0, key + " = " + json.dumps(value))
+            stateRows = _JsonRows(data.get("states", []), "state")
+            linkRows = _JsonRows(data.get("links", []), "link")
+            linksFile = None
+        else:
+            stateRows = _CsvRows(stream)
+            linkRows = ()
+            linksFile = base + LINKS_TABLE_SUFFIX
+
+        placed = set()  # States given a column
+        handlers = {}
+        for lc, row, line in stateRows:
+            state = State()
+            for key, value in row:
+                if key not in handlers:
+                    handlers[key] = TABLE_STATE_KEYS.get(NormaliseKey(key)) or _FindHandler(NormaliseKey(key), STATE_KEYS, STATE_KEYWORDS)
+                    if handlers[key] is None:
+                        print("WARNING: Ignoring unknown state column: " + key)
+                handler = handlers[key]
+                value = _TableValue(value)
+                if handler is None or value == "":
+                    continue
+                if handler in STATE_FLAGS:
+                    if value.upper() in TRUE_VALUES:
+                        handler(state, "", lc, line)
+                    continue
+                if handler is _StateColumn:
+                    placed.add(state)
+                handler(state, value, lc, line)
+            diagram.AddState(parser.FinishState(state))
+
+        if linksFile is not None and os.path.isfile(linksFile):
+            links = open(linksFile, 'r', newline='')
+            linkRows = _CsvRows(links)
+        else:
+            links = None
+        try:
+            malformed = 0
+            for lc, row, line in linkRows:
+                fields = {}
+                for key, value in row:
+                    field = TABLE_LINK_KEYS.get(NormaliseKey(key))
+                    if field is not None:
+                        fields[field] = _TableValue(value)
+                source = fields.get("source", "").upper()
+                target = fields.get("target", "").upper()
+                if source == "" or target == "":
+                    print("ERROR: Link on line " + str(lc) + " needs a source and a target:\n\t" + line)
+                    malformed += 1
+                else:
+                    diagram.AddLink(source, target, fields.get("colour") or 'BLACK')
+        finally:
+            if links is not None:
+                links.close()
+
+    parser.CheckOptions()
+    parser.SetDiagramOptions(diagram)
+    with profiler.Phase("check links"):
+        diagram.CheckLinks()
+    if malformed > 0:
+        raise ValueError("Links without a source or target.")
+    with profiler.Phase("columns"):
+        if len(placed) < len(diagram.layout.states):
+            AssignColumns(diagram, placed)
+    diagram.columns = max([s.column for s in diagram.layout.states] or [0]) + 1
+    return diagram
+
+def AssignColumns(diagram, placed=()):
+    """
+    Sets the column of every state not in placed by longest path layering of the links:
+    states nothing links to go in the first column, and every other state one column to
+    the right of the furthest state linking to it. Where links form a cycle, the first
+    state of it in input order is placed as if the link closing the cycle were missing.
+    Takes time proportional to the number of states plus links.
+    """
+    states = diagram.layout.states
+    statesList = diagram.statesList
+    n = len(states)
+    waiting = [0]*n     # Links into each state from states not yet placed
+    for _, dest, _ in diagram.links:
+        waiting[statesList[dest].layoutIndex] += 1
+    column = [0]*n
+    done = [False]*n
+    ready = collections.deque(i for i in range(n) if waiting[i] == 0)
+    nextUnplaced = 0
+    for _ in range(n):
+        while len(ready) > 0 and done[ready[0]]:
+            ready.popleft()
+        if len(ready) == 0:
+            # Only cycles are left
+            while done[nextUnplaced]:
+                nextUnplaced += 1
+            ready.append(nextUnplaced)
+        i = ready.popleft()
+        done[i] = True
+        state = states[i]
+        if state not in placed:
+            state.column = column[i]
+        for _, dest, _ in diagram.linksFrom.get(state.name, ()):
+            j = statesList[dest].layoutIndex
+            if done[j]:
+                continue
+            column[j] = max(column[j], state.column + 1)
+            waiting[j] -= 1
+            if waiting[j] == 0:
+                ready.append(j)
+    diagram.layout.Clear()
+
+
+######################################################################################################
+#           Pathway variants
+######################################################################################################
+
+VARIANT_KEYS = ("LEGEND", "FROM", "RANGE")
+
+def ParseVariant(text):
+    """
+    Reads a variant: a name followed by the filters picking its states, separated by
+    semicolons, such as "cat1; legend: Catalyst 1; from: Reactants; range: -12, 5".
+      legend  states drawn in the colours of the states with these legends, and the ends of links in those colours
+      from    states reachable from these states by following links
+      range   energy range to draw, in place of the diagram's own
+    Filters combine, so every state drawn passes all of them.
+    Returns a dict with the name, legends, sources and y_lims.
+    """
+    parts = text.split(";")
+    variant = {"name": parts[0].strip(), "legends": [], "sources": [], "y_lims": None}
+    if re.match(r"^[\w.+-]+$", variant["name"]) is None:
+        print("ERROR: A variant needs a name to add to its output file, found '" + variant["name"] + "' in: " + text)
+        raise ValueError("Bad variant name")
+    for part in parts[1:]:
+        key, _, value = part.partition(":")
+        key = NormaliseKey(key)
+        items = [v.strip() for v in value.split(",") if v.strip() != ""]
+        if key not in VARIANT_KEYS or len(items) == 0:
+            print("ERROR: Could not read '" + part.strip() + "' in variant " + variant["name"] + ", expected one of: legend, from, range")
+            raise ValueError("Bad variant filter")
+        if key == "LEGEND":
+            variant["legends"].extend(items)
+        elif key == "FROM":
+            variant["sources"].extend(n.upper() for n in items)
+        else:
+            try:
+                y_lims = [float(v) for v in items]
+            except ValueError:
+                y_lims = []
+            if len(y_lims) != 2:
+                print("ERROR: Variant " + variant["name"] + " needs two comma separated numbers for its range, e.g: range: -1, 2")
+                raise ValueError("Bad variant range")
+            variant["y_lims"] = y_lims
+    return variant
+
+def RenderVariants(diagram, options=None):
+    """
+    Draws each variant of a diagram, those from its input followed by any in options["variants"].
+    Every variant comes from the one parsed diagram, sharing its images and state positions.
+    Returns the names of the files written.
+    """
+    variants = diagram.variants
+    if options is not None and options.get("variants"):
+        variants = variants + options["variants"]
+    names = []
+    for variant in variants:
+        subset = diagram.Variant(variant)
+        ApplyOptions(subset, options)
+        try:
+            RenderDiagram(subset, options)
+        finally:
+            subset.Close()
+        names.extend(subset.OutputNames())
+    return names
+
+######################################################################################################
+#           Parsed input cache
+######################################################################################################
+
+# A sidecar file holds a parsed diagram as "ELCACHE" and a format byte, the length of a JSON
+# header as 8 little endian bytes, the header, then raw arrays each starting on an
+# ALIGNMENT byte boundary so they can be used straight from a memory map.
+PARSE_CACHE_MAGIC = b"ELCACHE\x01"
+PARSE_CACHE_EXTENSION = ".elcache"
+ALIGNMENT = 64
+
+def ParsedName(filename):
+    return filename + PARSE_CACHE_EXTENSION
+
+def _FileRecord(path):
+    """
+    What a sidecar remembers about a file it depends on: absolute path, modification
+    time, size and content hash, or only the path for a file that does not exist.
+    """
+    record = {"path": os.path.abspath(path), "mtime": None, "size": None, "sha1": None}
+    try:
+        stat = os.stat(path)
+        with open(path, 'rb') as f:
+            record["sha1"] = hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return record
+    record["mtime"] = stat.st_mtime
+    record["size"] = stat.st_size
+    return record
+
+def _FileUnchanged(record):
+    """
+    Whether a file still matches its record. The modification time and size are
+    enough when they agree, otherwise the contents are hashed again.
+    """
+    try:
+        stat = os.stat(record["path"])
+    except OSError:
+        return record["sha1"] is None
+    if record["sha1"] is None or stat.st_size != record["size"]:
+        return False
+    if stat.st_mtime == record["mtime"]:
+        return True
+    with open(record["path"], 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest() == record["sha1"]
+
+def _Dependencies(filename, diagram):
+    """
+    Every file the parsed diagram came from: the input, a network's links table
+    (whether or not it exists) and each image.
+    """
+    paths = [filename]
+    base, ext = os.path.splitext(filename)
+    if ext.lower() == ".csv":
+        paths.append(base + LINKS_TABLE_SUFFIX)
+    for state in diagram.layout.states:
+        if state.imagePath is not None and state.imagePath not in paths:
+            paths.append(state.imagePath)
+    return paths
+
+# Numeric state attributes stored as arrays, with their dtype and columns per state
+STATE_ARRAYS = (
+    ("energy", "<f8", 1),
+    ("normalisedPosition", "<f8", 1),
+    ("column", "<i8", 1),
+    ("labelOffset", "<f8", 2),
+    ("textOffset", "<f8", 2),
+    ("imageOffset", "<f8", 2),
+    ("imageScale", "<f8", 1),
+    ("show_energy", "u1", 1),
+)
+STATE_STRINGS = ("name", "color", "labelColor", "linksTo", "label", "legend", "imagePath", "imageKey")
+DEFAULT_OFFSETS = ("labelOffset", "textOffset", "imageOffset")
+
+def StoreParsed(filename, diagram):
+    """
+    Writes the parsed diagram to the sidecar file of filename: its options, links and
+    state table, plus each decoded image once. Failing to write is only a warning.
+    """
+    _ImportNumpy()
+    states = diagram.layout.states
+    n = len(states)
+    arrays = []
+    for name, dtype, width in STATE_ARRAYS:
+        values = np.array([getattr(s, name) for s in states], dtype=dtype)
+        arrays.append(("state." + name, values.reshape((n, width)) if width > 1 else values))
+    # Offsets left at their (0,0) default are told apart from ones set to 0,0 in the input,
+    # so the loaded states fingerprint exactly as freshly parsed ones do
+    plain = np.zeros(n, dtype="u1")
+    for i, s in enumerate(states):
+        for bit, name in enumerate(DEFAULT_OFFSETS):
+            value = getattr(s, name)
+            if value == (0,0) and isinstance(value[0], int):
+                plain[i] |= 1 << bit
+    arrays.append(("state.plainOffsets", plain))
+    images = collections.OrderedDict()
+    imageIndex = np.full(n, -1, dtype="<i8")
+    for i, s in enumerate(states):
+        if s.image is not None:
+            if s.imageKey not in images:
+                images[s.imageKey] = len(images)
+                arrays.append(("image." + str(len(images) - 1), np.ascontiguousarray(s.image)))
+            imageIndex[i] = images[s.imageKey]
+    arrays.append(("state.imageIndex", imageIndex))
+
+    layout = {}
+    offset = 0
+    for name, array in arrays:
+        layout[name] = {"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)}
+        offset += -(-array.nbytes // ALIGNMENT)*ALIGNMENT
+    header = {
+        "version": VERSION,
+        "depends": [_FileRecord(path) for path in _Dependencies(filename, diagram)],
+        "options": {"width": diagram.width, "height": diagram.height, "fontSize": diagram.fontSize,
+            "outputName": diagram.outputName, "outputFormats": diagram.outputFormats,
+            "energyUnits": diagram.energyUnits, "y_lims": diagram.y_lims,
+            "variants": diagram.variants, "columns": diagram.columns},
+        "strings": dict((name, [getattr(s, name) for s in states]) for name in STATE_STRINGS),
+        "links": diagram.links,
+        "arrays": layout,
+        "dataSize": offset,
+    }
+    header = json.dumps(header).encode("utf-8")
+    start = len(PARSE_CACHE_MAGIC) + 8 + len(header)
+    padding = -start % ALIGNMENT
+
+    path = ParsedName(filename)
+    temp = "{:}.{:}.tmp".format(path, os.getpid())
+    try:
+        with open(temp, 'wb') as f:
+            f.write(PARSE_CACHE_MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            f.write(b"\0"*padding)
+            for name, array in arrays:
+                f.write(array.tobytes())
+                f.write(b"\0"*(-array.nbytes % ALIGNMENT))
+        os.replace(temp, path)  # So other processes never see a partly written file
+    except (IOError, OSError) as e:
+        print("WARNING: Could not write parse cache " + path + ": " + str(e))
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+
+@contextlib.contextmanager
+def _PausedGarbageCollection():
+    """
+    Holds off the cycle collector while many objects are made at once, as it would
+    otherwise scan them all repeatedly for cycles that are not there.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def LoadParsed(filename, profiler=NO_PROFILER):
+    """
+    Reads back the diagram stored by StoreParsed(), or returns None when there is no
+    sidecar file or the input or any of its images has changed since it was written.
+    The sidecar is memory mapped and the images are used from the map without copying.
+    """
+    path = ParsedName(filename)
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(PARSE_CACHE_MAGIC)) != PARSE_CACHE_MAGIC:
+                raise ValueError("not a parse cache")
+            length, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(length).decode("utf-8"))
+        # A header without these, e.g. from a build that wrote fewer fields, is unreadable too
+        version, depends, dataSize = header["version"], header["depends"], header["dataSize"]
+    except (IOError, OSError):
+        return None
+    except (ValueError, struct.error, KeyError, TypeError):
+        print("WARNING: Ignoring unreadable parse cache " + path)
+        return None
+    if version != VERSION or depends[0]["path"] != os.path.abspath(filename):
+        return None
+    if not all(_FileUnchanged(record) for record in depends):
+        return None
+
+    _ImportNumpy()
+    start = len(PARSE_CACHE_MAGIC) + 8 + length
+    start += -start % ALIGNMENT
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    if len(data) < start + dataSize:
+        print("WARNING: Ignoring truncated parse cache " + path)
+        return None
+    def Array(name):
+        entry = header["arrays"][name]
+        dtype = np.dtype(str(entry["dtype"]))
+        count = int(np.prod(entry["shape"]))
+        offset = start + entry["offset"]
+        return data[offset:offset + count*dtype.itemsize].view(dtype).reshape(entry["shape"])
+
+    options = header["options"]
+    diagram = Diagram(options["width"], options["height"], options["fontSize"], options["outputName"], options["y_lims"])
+    diagram.outputFormats = options["outputFormats"]
+    diagram.energyUnits = options["energyUnits"]
+    diagram.variants = options["variants"]
+    diagram.profiler = profiler
+
+    # The stored states already passed AddState() and CheckLinks(), so they are put straight
+    # into the diagram. This loop is most of the time taken, hence the plain assignments.
+    strings = header["strings"]
+    numbers = dict((name, Array("state." + name).tolist()) for name, _, _ in STATE_ARRAYS)
+    for name in DEFAULT_OFFSETS:
+        numbers[name] = list(map(tuple, numbers[name]))
+    for i, bits in enumerate(Array("state.plainOffsets").tolist()):
+        for bit, name in enumerate(DEFAULT_OFFSETS):
+            if bits & (1 << bit):
+                numbers[name][i] = (0,0)
+    images = {}
+    for index, key in set(zip(Array("state.imageIndex").tolist(), strings["imageKey"])):
+        if index >= 0:
+            images[key] = Array("image." + str(index))
+
+    layout = diagram.layout
+    statesList = diagram.statesList
+    table = [strings[name] for name in STATE_STRINGS] + [numbers[name] for name, _, _ in STATE_ARRAYS]
+    with _PausedGarbageCollection():
+        for i, values in enumerate(zip(*table)):
+            state = State.__new__(State)
+            (state.name, state.color, state.labelColor, state.linksTo, state.label, state.legend,
+                state.imagePath, state.imageKey, state.energy, state.normalisedPosition, state.column,
+                state.labelOffset, state.textOffset, state.imageOffset, state.imageScale, show_energy) = values
+            state.show_energy = show_energy == 1
+            state.image = images.get(state.imageKey)
+            state._leftPointx = state._leftPointy = state._rightPointx = state._rightPointy = 0
+            state.layout = layout
+            state.layoutIndex = i
+            layout.states.append(state)
+            statesList[state.name] = state
+        diagram.links = [tuple(link) for link in header["links"]]
+        for link in diagram.links:
+            diagram.linksFrom.setdefault(link[0], []).append(link)
+    diagram.do_legend = any(legend is not None for legend in strings["legend"])
+    diagram.columns = options["columns"]
+    diagram.linksChecked = True
+    return diagram
 
 ######################################################################################################
 #          Example printing function. Skip to bottom.
@@ -475,9 +2398,859 @@ def MakeExampleFile():
     output.close()
     print("Made example file as 'example.inp'.")
 
+######################################################################################################
+#           Render cache
+######################################################################################################
+
+class RenderCache:
+    """
+    Directory of previously rendered images, keyed on a hash of the parsed diagram, the
+    contents of its images and the rendering settings. A hit copies the stored image to
+    the output file, skipping Draw() and savefig entirely. The least recently used
+    entries are removed once the directory grows past maxSize bytes.
+    """
+    def __init__(self, directory, maxSize=500*1024*1024):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def Key(self, diagram, options=None):
+        digest = hashlib.sha1()
+        def Add(*values):
+            digest.update(repr(values).encode("utf-8"))
+            digest.update(b"\n")
+
+        Add(VERSION, _MatplotlibVersion(), sorted((options or {}).items()))
+        Add(diagram.width, diagram.height, diagram.fontSize, diagram.y_lims, diagram.energyUnits,
+            [os.path.splitext(name)[1].lower() for name in diagram.OutputNames()], diagram.useCollections)
+        for state in diagram.statesList.values():
+            Add(state.Fingerprint())
+        for link in diagram.links:
+            Add(link)
+        return digest.hexdigest()
+
+    def Path(self, key, outputName):
+        return os.path.join(self.directory, key + os.path.splitext(outputName)[1].lower())
+
+    def Fetch(self, key, outputNames):
+        """
+        Copies the cached images for key to each of outputNames, returning False unless all are held.
+        """
+        paths = [self.Path(key, name) for name in outputNames]
+        try:
+            for path, name in zip(paths, outputNames):
+                shutil.copyfile(path, name)
+                os.utime(path, None)    # Mark as recently used
+        except (IOError, OSError):
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def Store(self, key, outputNames):
+        """
+        Keeps copies of freshly rendered output files. Failing to is only a warning, as the
+        render itself succeeded.
+        """
+        for name in outputNames:
+            path = self.Path(key, name)
+            temp = "{:}.{:}.tmp".format(path, os.getpid())
+            try:
+                shutil.copyfile(name, temp)
+                os.replace(temp, path)  # So other processes never see a partly written entry
+            except (IOError, OSError) as e:
+                print("WARNING: Could not store " + name + " in the render cache: " + str(e))
+                try:
+                    os.remove(temp)
+                except OSError:
+                    pass
+                return
+        self.Evict()
+
+    def Evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue    # Removed by another process
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        while total > self.maxSize and len(entries) > 0:
+            _, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+_RENDER_CACHES = {}
+
+def GetRenderCache(options):
+    """
+    Returns the RenderCache asked for in options, shared by every file a process renders, or None.
+    """
+    if options is None or options.get("cache") is None:
+        return None
+    directory = options["cache"]
+    if directory not in _RENDER_CACHES:
+        _RENDER_CACHES[directory] = RenderCache(directory, options.get("cacheSize", 500)*1024*1024)
+    return _RENDER_CACHES[directory]
+
+def RenderDiagram(diagram, options=None):
+    """
+    Lays out and draws a diagram to its output file, unless the render cache already holds it.
+    Returns True when the output came from the cache.
+    """
+    cache = GetRenderCache(options)
+    if cache is not None:
+        with diagram.profiler.Phase("render cache"):
+            diagram.HashImages()
+            key = cache.Key(diagram, RenderSettings(options))
+            hit = cache.Fetch(key, diagram.OutputNames())
+        diagram.profiler.Count("render cache hits" if hit else "render cache misses")
+        if hit:
+            return True
+
+    with diagram.profiler.Phase("import matplotlib"):
+        _ImportMatplotlib()
+    # rc_context stops the font size of one input leaking into the next in the same process
+    with matplotlib.rc_context():
+        if diagram.layout.leftx is None:    # Variants come with positions from their full diagram
+            diagram.MakeLeftRightPoints()
+        diagram.Draw()
+    if cache is not None:
+        cache.Store(key, diagram.OutputNames())
+    return False
+
+def ReadForRender(filename, options=None, profiler=NO_PROFILER):
+    """
+    Reads an input file to be drawn with RenderDiagram(). With a render cache in use its
+    images are only hashed for the cache key, and decoded by Draw() on a miss, so a hit
+    neither decodes them nor imports matplotlib. The parse cache holds decoded images
+    already, so they are taken from there when it is in use.
+    """
+    options = options or {}
+    parseCache = options.get("parseCache", False)
+    lazyImages = options.get("cache") is not None and not parseCache
+    return ReadInput(filename, loadImages=not lazyImages, profiler=profiler, parseCache=parseCache)
+
+def RenderBytes(diagram, format=None, options=None):
+    """
+    Lays out and draws a diagram to memory, returning the image as bytes. format defaults
+    to the output file's extension, or png when it has none. The figure is always closed
+    afterwards so a long running process can render any number of diagrams.
+    """
+    if format is None:
+        format = os.path.splitext(diagram.outputName)[1][1:].lower() or "png"
+    ApplyOptions(diagram, options)
+    with diagram.profiler.Phase("import matplotlib"):
+        _ImportMatplotlib()
+    buffer = io.BytesIO()
+    try:
+        with matplotlib.rc_context():
+            if diagram.layout.leftx is None:
+                diagram.MakeLeftRightPoints()
+            with diagram.profiler.Phase("draw"):
+                diagram.DrawArtists()
+            diagram.Save(buffer, format)
+    finally:
+        diagram.Close()
+    return buffer.getvalue()
+
+def RenderString(text, format=None, options=None, basePath=None, restrictImages=False):
+    """
+    Reads input from a string and returns the drawn image as bytes, see RenderBytes().
+    With restrictImages set only relative image paths within basePath, or the working
+    directory, are allowed, see ReadStream().
+    """
+    return RenderBytes(ReadString(text, basePath=basePath, restrictImages=restrictImages), format, options)
+
+def RenderMultipage(filenames, outputName, options=None):
+    """
+    Draws every input file as one page of a single PDF, in the order given, so fonts are
+    embedded once for the whole document. A file that fails is reported and left out.
+    Returns the RenderFile style results.
+    """
+    _ImportMatplotlib()
+    from matplotlib.backends.backend_pdf import PdfPages
+    results = []
+    with PdfPages(outputName) as pdf:
+        for filename in filenames:
+            start = time.time()
+            log = StringIO()
+            try:
+                with RedirectOutput(log):
+                    diagram = ReadInput(filename, parseCache=options is not None and options.get("parseCache"))
+                    ApplyOptions(diagram, options)
+                    try:
+                        with matplotlib.rc_context():
+                            diagram.MakeLeftRightPoints()
+                            diagram.DrawArtists()
+                            diagram.Save(pdf, "pdf")
+                    finally:
+                        diagram.Close()
+                results.append((filename, True, "page {:}".format(pdf.get_pagecount()), time.time() - start, False, None))
+                print("  [ OK ] {:} -> {:} page {:} ({:.2f} s)".format(filename, outputName, pdf.get_pagecount(), time.time() - start))
+            except (Exception, SystemExit) as e:
+                results.append((filename, False, ErrorMessage(e, log), time.time() - start, False, None))
+                print("  [FAIL] {:}: {:}".format(filename, results[-1][2]))
+    return results
+
+######################################################################################################
+#           Animation
+######################################################################################################
+
+def RenderAnimation(diagram, outputName, reveal="paths", frameTime=800):
+    """
+    Draws a step by step reveal of a diagram, see Diagram.DrawFrames(). A .gif outputName
+    is written as an animated GIF showing each frame for frameTime milliseconds, anything
+    else is a directory the frames are written to as numbered PNG files.
+    Returns the names of the files written.
+    """
+    with diagram.profiler.Phase("import matplotlib"):
+        _ImportMatplotlib()
+    from PIL import Image   # Always installed alongside matplotlib
+
+    gif = os.path.splitext(outputName)[1].lower() == ".gif"
+    if not gif and not os.path.isdir(outputName):
+        os.makedirs(outputName)
+    base = os.path.splitext(os.path.basename(diagram.outputName or "frame"))[0]
+    names = []
+    frames = []
+    with matplotlib.rc_context():
+        diagram.MakeLeftRightPoints()
+        try:
+            for i, frame in enumerate(diagram.DrawFrames(reveal)):
+                with diagram.profiler.Phase("save frames"):
+                    if gif:
+                        frames.append(Image.fromarray(frame).convert("RGB"))
+                    else:
+                        name = os.path.join(outputName, "{:}-{:03d}.png".format(base, i))
+                        Image.fromarray(frame).save(name)
+                        names.append(name)
+        finally:
+            diagram.Close()
+    if gif:
+        if len(frames) == 0:
+            print("ERROR: " + outputName + " would have no frames, the diagram has no states.")
+            raise ValueError("No frames to animate")
+        with diagram.profiler.Phase("save frames"):
+            frames[0].save(outputName, save_all=True, append_images=frames[1:], duration=frameTime, loop=0)
+        names.append(outputName)
+    return names
+
+######################################################################################################
+#           Batch rendering
+######################################################################################################
+
+def FindInputFiles(paths):
+    """
+    Expands the command line inputs into a list of input files.
+    Each entry may be a file, a glob pattern or a directory (all the *.inp files and
+    network tables within are used). The links tables of networks are never matched
+    on their own, see ReadNetwork().
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = []
+            for extension in (".inp",) + NETWORK_EXTENSIONS:
+                matches.extend(glob.glob(os.path.join(path, "*" + extension)))
+            matches = sorted(m for m in matches if not IsLinksTable(m))
+        elif os.path.exists(path):
+            matches = [path]
+        else:
+            matches = sorted(m for m in glob.glob(path) if not IsLinksTable(m))
+        if len(matches) == 0:
+            print("WARNING: No input files found for: " + path)
+        for match in matches:
+            if match not in files:
+                files.append(match)
+    return files
+
+def RenderFile(filename, options=None, quiet=False):
+    """
+    Reads and draws a single input file, returning (filename, success, message, seconds, cached, profile).
+    profile is the Profiler report when options["profile"] is set, otherwise None.
+    options is a dict of rendering settings from the command line, see ApplyOptions().
+    Errors are caught and reported in the message so one bad file does not stop a batch.
+    When quiet is set the messages printed while rendering are captured rather than shown.
+    """
+    start = time.time()
+    log = StringIO()
+    profiler = NO_PROFILER
+    if options is not None and options.get("profile"):
+        profiler = Profiler()
+    try:
+        with RedirectOutput(log, quiet):
+            diagram = ReadForRender(filename, options, profiler)
+            ApplyOptions(diagram, options)
+            try:
+                cached = RenderDiagram(diagram, options)
+                names = diagram.OutputNames() + RenderVariants(diagram, options)
+            finally:
+                diagram.Close()
+        return (filename, True, ", ".join(names), time.time() - start, cached, ProfileReport(profiler, filename))
+    except (Exception, SystemExit) as e:
+        return (filename, False, ErrorMessage(e, log), time.time() - start, False, ProfileReport(profiler, filename))
+
+def ErrorMessage(e, log):
+    """
+    One line describing a failed render: the exception plus any ERROR lines printed before it.
+    """
+    message = "{:}: {:}".format(type(e).__name__, e)
+    errors = [l.strip() for l in log.getvalue().splitlines() if "ERROR" in l]
+    if len(errors) > 0:
+        message += " (" + "; ".join(errors) + ")"
+    return message
+
+def ProfileReport(profiler, filename):
+    if not profiler.enabled:
+        return None
+    report = profiler.Report()
+    report["file"] = filename
+    return report
+
+def _RenderFileQuiet(filename, options=None):
+    return RenderFile(filename, options, quiet=True)
+
+def RenderBatch(filenames, jobs=None, options=None):
+    """
+    Renders many input files across a pool of worker processes.
+    Each worker imports matplotlib once and is reused for many files.
+    Returns the list of RenderFile results in the order they finished.
+    """
+    if jobs is None or jobs < 1:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(filenames))
+
+    results = []
+    start = time.time()
+    if jobs <= 1:
+        mapped = (_RenderFileQuiet(f, options) for f in filenames)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs)
+        mapped = pool.imap_unordered(functools.partial(_RenderFileQuiet, options=options), filenames)
+    try:
+        for result in mapped:
+            results.append(result)
+            filename, success, message, seconds, cached, profile = result
+            if success and cached:
+                print("  [HIT ] {:} -> {:} ({:.2f} s)".format(filename, message, seconds))
+            elif success:
+                print("  [ OK ] {:} -> {:} ({:.2f} s)".format(filename, message, seconds))
+            else:
+                print("  [FAIL] {:}: {:}".format(filename, message))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+
+    failed = len([r for r in results if not r[1]])
+    print("o=======================================================o")
+    print("  Rendered {:} of {:} files in {:.2f} s using {:} worker(s)".format(
+        len(results) - failed, len(results), elapsed, max(jobs, 1)))
+    if elapsed > 0:
+        print("  Throughput: {:.2f} files/s".format(len(results)/elapsed))
+    if options is not None and options.get("cache") is not None:
+        hits = len([r for r in results if r[4]])
+        print("  Render cache: {:} hit(s), {:} miss(es)".format(hits, len(results) - failed - hits))
+    if failed > 0:
+        print("  {:} file(s) failed".format(failed))
+    print("o=======================================================o")
+    return results
+
+class RedirectOutput:
+    """
+    Context manager that sends stdout to the given stream when active is True.
+    """
+    def __init__(self, stream, active=True):
+        self.stream = stream
+        self.active = active
+        self.saved = None
+
+    def __enter__(self):
+        if self.active:
+            self.saved = sys.stdout
+            sys.stdout = self.stream
+        return self.stream
+
+    def __exit__(self, *args):
+        if self.active:
+            sys.stdout = self.saved
+        return False
+
+######################################################################################################
+#           Input checking
+######################################################################################################
+
+def CheckRanges(diagram):
+    """
+    Looks for values that read correctly but would give a broken or misleading diagram.
+    Returns a list of messages, those starting with ERROR are fatal.
+    """
+    problems = []
+    if diagram.width < 0 or diagram.height < 0:
+        problems.append("ERROR: Diagram width and height must be positive.")
+    if diagram.sorted_y_lims is not None and diagram.sorted_y_lims[0] == diagram.sorted_y_lims[1]:
+        problems.append("ERROR: Energy range is empty, the two values must differ.")
+    for state in diagram.statesList.values():
+        if state.column < 0:
+            problems.append("ERROR: State " + state.name + " has column " + str(state.column + 1) + ", columns start from 1.")
+        if diagram.sorted_y_lims is not None and not (diagram.sorted_y_lims[0] <= state.energy <= diagram.sorted_y_lims[1]):
+            problems.append("WARNING: State " + state.name + " at energy " + str(state.energy) + " is outside the energy range and will not be seen.")
+    return problems
+
+def CheckFile(filename):
+    """
+    Reads an input and checks its links and values without drawing or importing matplotlib.
+    Returns (filename, success, messages, seconds), where messages are the errors and warnings found.
+    """
+    start = time.time()
+    log = StringIO()
+    problems = []
+    success = True
+    try:
+        with RedirectOutput(log):
+            diagram = ReadInput(filename, loadImages=False)
+        problems = CheckRanges(diagram)
+    except (Exception, SystemExit) as e:
+        problems.append("ERROR: {:}: {:}".format(type(e).__name__, e))
+    messages = [l.strip() for l in log.getvalue().splitlines() if "ERROR" in l or "WARNING" in l] + problems
+    success = not any(m.startswith("ERROR") for m in messages)
+    return (filename, success, messages, time.time() - start)
+
+def CheckBatch(filenames):
+    results = []
+    start = time.time()
+    for filename in filenames:
+        result = CheckFile(filename)
+        results.append(result)
+        filename, success, messages, seconds = result
+        print("  [{:}] {:} ({:.1f} ms)".format(" OK " if success else "FAIL", filename, seconds*1000))
+        for message in messages:
+            print("         " + message)
+    elapsed = time.time() - start
+
+    failed = len([r for r in results if not r[1]])
+    print("o=======================================================o")
+    print("  Checked {:} file(s) in {:.3f} s, {:} failed".format(len(results), elapsed, failed))
+    print("o=======================================================o")
+    return results
+
+######################################################################################################
+#           Watch mode
+######################################################################################################
+
+def _WatchedFiles(filename, diagram):
+    """
+    The input file and every image it uses, with the modification times to compare against.
+    """
+    files = [filename]
+    if diagram is not None:
+        files += [s.imagePath for s in diagram.statesList.values() if s.imagePath is not None]
+    stamps = {}
+    for path in files:
+        try:
+            stamps[path] = os.stat(path).st_mtime
+        except OSError:
+            stamps[path] = None
+    return stamps
+
+def Watch(filename, options=None, interval=0.5):
+    """
+    Draws filename, then keeps the figure alive and redraws it whenever the input or one
+    of its images changes. Changed states and links are updated in place through
+    Diagram.Update(); the figure is only rebuilt when that is not possible.
+    Runs until interrupted with Ctrl-C.
+    """
+    diagram = None
+    stamps = {}
+    print("Watching " + filename + " for changes. Press Ctrl-C to stop.")
+    try:
+        while True:
+            if stamps != _WatchedFiles(filename, diagram):
+                start = time.time()
+                try:
+                    new = ReadInput(filename)
+                    ApplyOptions(new, options)
+                    new.MakeLeftRightPoints()
+                    if diagram is not None and diagram.Update(new):
+                        diagram.Save()
+                        print("Updated {:} state(s) and {:} link(s) in {:} ({:.2f} s)".format(
+                            diagram.lastUpdate[0], diagram.lastUpdate[1], diagram.outputName, time.time() - start))
+                    else:
+                        if diagram is not None:
+                            diagram.Close()
+                        new.Draw()
+                        diagram = new
+                        print("Drew {:} ({:.2f} s)".format(diagram.outputName, time.time() - start))
+                except (Exception, SystemExit) as e:
+                    print("ERROR: Could not redraw, keeping the last image. {:}: {:}".format(type(e).__name__, e))
+                stamps = _WatchedFiles(filename, diagram)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\nStopped watching " + filename)
+    finally:
+        if diagram is not None:
+            diagram.Close()
+
+######################################################################################################
+#           Render server
+######################################################################################################
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "pdf": "application/pdf",
+    "svg": "image/svg+xml",
+    "eps": "application/postscript",
+    "ps":  "application/postscript",
+}
+
+MAX_REQUEST_BYTES = 16*1024*1024    # Larger posted inputs are refused without being read
+
+# Drawn by each worker as it starts, so fonts and mathtext are loaded before the first request
+WARMUP_INPUT = """
+width = 2
+height = 2
+{
+    name   = warmup
+    label  = A$_1^{++}$
+    energy = 0.0
+    column = 1
+}
+"""
+
+def _RenderWorkerLoop(conn, options):
+    """
+    Body of a render worker process: renders (text, format) requests from conn until sent None,
+    replying (True, image bytes) or (False, error message).
+    """
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # Ctrl-C stops the server, which then stops its workers
+    log = StringIO()
+    with RedirectOutput(log):
+        RenderString(WARMUP_INPUT, "png", options)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        text, format = request
+        log = StringIO()
+        try:
+            with RedirectOutput(log):
+                # Requests may come from anywhere --host allows, so they only get images under the working directory
+                reply = (True, RenderString(text, format, options, restrictImages=True))
+        except (Exception, SystemExit) as e:
+            reply = (False, ErrorMessage(e, log))
+        conn.send(reply)
+
+class RenderWorker:
+    """
+    A pre-warmed process with matplotlib loaded, rendering one request at a time over a pipe.
+    """
+    def __init__(self, options=None):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_RenderWorkerLoop, args=(child, options))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def Render(self, text, format, timeout):
+        """
+        Returns (success, image bytes or message), or None when timeout seconds pass first.
+        """
+        self.conn.send((text, format))
+        if not self.conn.poll(timeout):
+            return None
+        return self.conn.recv()
+
+    def Stop(self, kill=False):
+        if kill:
+            self.process.terminate()
+        else:
+            try:
+                self.conn.send(None)
+            except (IOError, OSError):
+                pass
+        self.process.join(5)
+        self.conn.close()
+
+class RenderServer:
+    """
+    Shares render requests between a fixed pool of RenderWorkers. Up to len(workers)
+    requests render at once, maxQueue more wait for a free worker and any beyond that are
+    turned away. A worker that overruns the timeout is killed and replaced.
+    """
+    def __init__(self, jobs=None, timeout=60.0, maxQueue=32, options=None):
+        if jobs is None or jobs < 1:
+            jobs = multiprocessing.cpu_count()
+        self.jobs = jobs
+        self.timeout = timeout
+        self.maxQueue = maxQueue
+        self.options = options
+        self.idle = queue.Queue()
+        for _ in range(jobs):
+            self.idle.put(RenderWorker(options))
+
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.pending = 0    # Requests admitted and not yet answered, rendering or waiting
+        self.counts = {"requests": 0, "rendered": 0, "failed": 0, "errors": 0, "timeouts": 0, "rejected": 0}
+        self.latencies = []  # Seconds taken by the most recent requests, for the stats
+
+    def Render(self, text, format):
+        """
+        Renders input text, returning (HTTP status, image bytes or error message).
+        """
+        if format not in CONTENT_TYPES:
+            return self.Refuse(400, "Unknown format '{:}', expected one of: {:}".format(format, ", ".join(sorted(CONTENT_TYPES))))
+        with self.lock:
+            self.counts["requests"] += 1
+            if self.pending >= self.jobs + self.maxQueue:
+                self.counts["rejected"] += 1
+                return 503, "Server busy, {:} requests already pending".format(self.pending)
+            self.pending += 1
+
+        start = time.time()
+        worker = self.idle.get()
+        try:
+            try:
+                reply = worker.Render(text, format, self.timeout)
+            except (IOError, OSError, EOFError):
+                reply = False   # The worker died, e.g. killed by the OS for running out of memory
+            if reply is None or reply is False:
+                worker.Stop(kill=True)
+                worker = RenderWorker(self.options)
+            if reply is None:
+                status, result = 504, "Render did not finish within {:} s".format(self.timeout)
+            elif reply is False:
+                status, result = 500, "Render worker stopped unexpectedly"
+            elif reply[0]:
+                status, result = 200, reply[1]
+            else:
+                status, result = 400, reply[1]
+        finally:
+            self.idle.put(worker)
+            with self.lock:
+                self.pending -= 1
+
+        with self.lock:
+            self.counts[{200: "rendered", 400: "failed", 500: "errors", 504: "timeouts"}[status]] += 1
+            self.latencies.append(time.time() - start)
+            del self.latencies[:-1000]
+        return status, result
+
+    def Refuse(self, status, message):
+        """
+        Counts a request turned away before it could be rendered, e.g. for an unreadable body.
+        """
+        with self.lock:
+            self.counts["requests"] += 1
+            self.counts["failed"] += 1
+        return status, message
+
+    def Stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = dict(self.counts)
+            stats["workers"] = self.jobs
+            stats["pending"] = self.pending
+            stats["queued"] = max(self.pending - self.jobs, 0)
+            stats["maxQueue"] = self.maxQueue
+            stats["uptime"] = time.time() - self.started
+        if len(latencies) > 0:
+            stats["latency"] = {
+                "mean": sum(latencies)/len(latencies),
+                "p50":  latencies[len(latencies)//2],
+                "p95":  latencies[min(int(len(latencies)*0.95), len(latencies) - 1)],
+                "max":  latencies[-1],
+            }
+        return stats
+
+    def Stop(self):
+        for _ in range(self.jobs):
+            self.idle.get().Stop()
+
+def _MakeRequestHandler(server):
+    """
+    The HTTP handler class for a RenderServer. http.server is only imported when serving.
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler
+        from urllib.parse import urlparse, parse_qs
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler
+        from urlparse import urlparse, parse_qs
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if urlparse(self.path).path != "/stats":
+                self.Reply(404, "Not found, use POST /render or GET /stats")
+                return
+            self.Reply(200, json.dumps(server.Stats(), indent=2), "application/json")
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/render":
+                self.Reply(404, "Not found, use POST /render or GET /stats")
+                return
+            format = parse_qs(url.query).get("format", ["png"])[0].lower()
+            status, result = self.ReadBody()
+            if status == 200:
+                status, result = server.Render(result, format)
+            else:
+                status, result = server.Refuse(status, result)
+            if status == 200:
+                self.Reply(status, result, CONTENT_TYPES[format])
+            else:
+                self.Reply(status, result)
+
+        def ReadBody(self):
+            """
+            Reads the posted input text, returning (HTTP status, text or error message).
+            """
+            length = self.headers.get("Content-Length")
+            if length is None:
+                return 411, "Content-Length is required"
+            try:
+                length = int(length)
+            except ValueError:
+                return 400, "Content-Length '{:}' is not a number".format(length)
+            if length < 0:
+                return 400, "Content-Length {:} is negative".format(length)
+            if length > MAX_REQUEST_BYTES:
+                self.close_connection = True    # The unread body must not be taken for the next request
+                return 413, "Input of {:} bytes is larger than the limit of {:} bytes".format(length, MAX_REQUEST_BYTES)
+            body = self.rfile.read(length)
+            try:
+                return 200, body.decode("utf-8")
+            except UnicodeDecodeError as e:
+                return 400, "Input is not valid UTF-8: {:}".format(e)
+
+        def Reply(self, status, body, contentType="text/plain"):
+            if not isinstance(body, bytes):
+                body = (body + "\n").encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return RequestHandler
+
+def Serve(port, host="127.0.0.1", jobs=None, timeout=60.0, maxQueue=32, options=None):
+    """
+    Runs a local HTTP render daemon until interrupted with Ctrl-C.
+    POST input text to /render?format=png (or pdf, svg, ...) to get the image back,
+    and GET /stats for request counts, queue depth and latencies.
+    """
+    try:
+        from http.server import HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = RenderServer(jobs, timeout, maxQueue, options)
+    httpd = ThreadingHTTPServer((host, port), _MakeRequestHandler(server))
+    print("Serving on http://{:}:{:}/ with {:} worker(s). Press Ctrl-C to stop.".format(host, httpd.server_address[1], server.jobs))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped serving")
+    finally:
+        httpd.server_close()
+        server.Stop()
+
 ######################################################################################################
 #           Main driver function
 ######################################################################################################
+
+def ApplyOptions(diagram, options):
+    """
+    Applies rendering settings given on the command line to a freshly read diagram.
+    """
+    if options is None:
+        return
+    diagram.useCollections = options.get("collections", False)
+    diagram.fastLayout = options.get("fastLayout", False)
+    diagram.avoidOverlaps = options.get("avoidOverlaps", False)
+    if options.get("formats"):
+        diagram.outputFormats = options["formats"]
+
+def RenderSettings(options):
+    """
+    The options that change how an image looks, as opposed to how it is produced.
+    """
+    if options is None:
+        return {}
+    return dict((k, v) for k, v in options.items() if k not in ("cache", "cacheSize", "profile", "variants", "parseCache"))
+
+def ParseArguments(argv):
+    parser = argparse.ArgumentParser(prog="EnergyLeveller.py",
+        description="Draws to-scale energy level diagrams from input files.")
+    parser.add_argument("inputs", nargs="*", metavar="INPUT",
+        help="input file(s). Globs and directories of .inp files and .csv/.json networks are accepted.")
+    parser.add_argument("--check", action="store_true",
+        help="only read and check the inputs for errors, without drawing. Does not load matplotlib.")
+    parser.add_argument("--formats", nargs="+", metavar="FORMAT", default=None,
+        help="also save each diagram in these formats (e.g. pdf png svg), drawing it only once.")
+    parser.add_argument("--multipage", metavar="FILE", default=None,
+        help="draw all the inputs as the pages of one PDF, FILE, instead of their own output files.")
+    parser.add_argument("--collections", action="store_true",
+        help="draw states and links as batched line collections. Much faster for large diagrams.")
+    parser.add_argument("--fast-layout", action="store_true",
+        help="work out axis limits and margins directly rather than with tight_layout. Much faster with many labels.")
+    parser.add_argument("--avoid-overlaps", action="store_true",
+        help="nudge state labels and energy values apart where they would overlap. Explicit offsets are kept.")
+    parser.add_argument("--variant", action="append", metavar="SPEC", default=[],
+        help="also draw a subset of each diagram, e.g. \"cat1; legend: Catalyst 1; from: R; range: -12, 5\". "
+        "May be repeated. The output name gets -NAME added.")
+    parser.add_argument("--cache", metavar="DIR", default=None,
+        help="keep rendered images in DIR and reuse them when an input and its images are unchanged.")
+    parser.add_argument("--cache-size", metavar="MB", type=float, default=500,
+        help="maximum size of the render cache before the least recently used images are removed (default: 500).")
+    parser.add_argument("--parse-cache", action="store_true",
+        help="keep each parsed input, images included, in a binary INPUT.elcache file next to it and "
+        "read that instead while the input and its images are unchanged.")
+    parser.add_argument("--profile", metavar="FILE", default=None,
+        help="time each phase of reading and drawing, and write the results to FILE as JSON.")
+    parser.add_argument("--watch", action="store_true",
+        help="keep running and redraw the input whenever it, or an image it uses, changes.")
+    parser.add_argument("--animate", metavar="OUT", default=None,
+        help="draw the input as a step by step reveal: an animated GIF if OUT ends .gif, else a directory of PNG frames.")
+    parser.add_argument("--reveal", choices=("paths", "states"), default="paths",
+        help="reveal one path (the states of one colour) or one state per frame of --animate. Default paths.")
+    parser.add_argument("--frame-time", type=int, metavar="MS", default=800,
+        help="time each frame of an animated GIF is shown for, in milliseconds. Default 800.")
+    parser.add_argument("--serve", metavar="PORT", type=int, default=None,
+        help="run a render daemon on localhost PORT instead. POST input to /render?format=png, GET /stats.")
+    parser.add_argument("--host", default="127.0.0.1",
+        help="address the render daemon listens on (default: 127.0.0.1).")
+    parser.add_argument("--timeout", metavar="SECONDS", type=float, default=60,
+        help="time allowed for each render daemon request before its worker is restarted (default: 60).")
+    parser.add_argument("--max-queue", metavar="N", type=int, default=32,
+        help="render daemon requests allowed to wait for a worker before more are refused (default: 32).")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+        help="number of worker processes used when rendering several inputs or serving (default: CPU count).")
+    return parser.parse_args(argv)
+
 def main():
 
     print("o=======================================================o")
@@ -489,16 +3262,84 @@ def main():
             print("\nAn example file will be made.")
             MakeExampleFile()
         raise IOError("No Input file provided.")
-    if (len(sys.argv) > 2):
-        print("Incorrect arguments. Correct call:\npython EnergyLeveler.py <INPUT FILE>")
-        raise ValueError("Incorrect Arguments.")
 
-    diagram = ReadInput(sys.argv[1])
-    diagram.MakeLeftRightPoints()
-    diagram.Draw()
+    args = ParseArguments(sys.argv[1:])
+    if args.serve is not None:
+        Serve(args.serve, args.host, args.jobs, args.timeout, args.max_queue,
+            {"collections": args.collections, "fastLayout": args.fast_layout,
+             "avoidOverlaps": args.avoid_overlaps})
+        return
+
+    inputs = FindInputFiles(args.inputs)
+    if len(inputs) == 0:
+        raise IOError("No Input files found.")
+
+    formats = None
+    if args.formats is not None:
+        formats = [f.lstrip('.').lower() for f in args.formats]
+        for format in formats:
+            if format not in OUTPUT_FORMATS:
+                print("ERROR: Unknown output format '" + format + "', expected one of: " + ", ".join(OUTPUT_FORMATS))
+                raise ValueError("Unknown output format " + format)
+    options = {"collections": args.collections, "fastLayout": args.fast_layout,
+        "avoidOverlaps": args.avoid_overlaps, "cache": args.cache,
+        "cacheSize": args.cache_size, "profile": args.profile is not None, "formats": formats,
+        "variants": [ParseVariant(v) for v in args.variant], "parseCache": args.parse_cache}
+
+    if args.check:
+        results = CheckBatch(inputs)
+        if not all(r[1] for r in results):
+            sys.exit(1)
+        return
+
+    if args.watch:
+        if len(inputs) > 1:
+            raise ValueError("Only one input file can be watched.")
+        Watch(inputs[0], options)
+        return
+
+    if args.animate is not None:
+        if len(inputs) > 1:
+            raise ValueError("Only one input file can be animated.")
+        profiler = Profiler(enabled=args.profile is not None)
+        diagram = ReadInput(inputs[0], profiler=profiler, parseCache=args.parse_cache)
+        ApplyOptions(diagram, options)
+        RenderAnimation(diagram, args.animate, args.reveal, args.frame_time)
+        if args.profile is not None:
+            WriteProfile(args.profile, ProfileReport(profiler, inputs[0]))
+        print("o=======================================================o")
+        print("         {:} frame(s) written to {:}".format(len(diagram.RevealSteps(args.reveal)), args.animate))
+        print("o=======================================================o")
+        return
+
+    if args.multipage is not None:
+        results = RenderMultipage(inputs, args.multipage, options)
+        print("o=======================================================o")
+        print("         {:} page(s) written to {:}".format(len([r for r in results if r[1]]), args.multipage))
+        print("o=======================================================o")
+        if not all(r[1] for r in results):
+            sys.exit(1)
+        return
+
+    if len(inputs) > 1:
+        results = RenderBatch(inputs, args.jobs, options)
+        if args.profile is not None:
+            WriteProfile(args.profile, [r[5] for r in results])
+        if not all(r[1] for r in results):
+            sys.exit(1)
+        return
+
+    profiler = Profiler(enabled=args.profile is not None)
+    diagram = ReadForRender(inputs[0], options, profiler)
+    ApplyOptions(diagram, options)
+    if RenderDiagram(diagram, options):
+        print("Unchanged since last render, image taken from cache " + args.cache)
+    names = diagram.OutputNames() + RenderVariants(diagram, options)
+    if args.profile is not None:
+        WriteProfile(args.profile, ProfileReport(profiler, inputs[0]))
 
     print("o=======================================================o")
-    print("         Image "+diagram.outputName+" made!")
+    print("         Image "+", ".join(names)+" made!")
     print("o=======================================================o")
 
 if __name__ == "__main__":
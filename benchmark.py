@@ -0,0 +1,565 @@
+#!/opt/local/bin/python
+# coding=UTF-8
+
+"""
+Benchmarks for Energy Leveller.
+
+    python benchmark.py suite [options]
+        Generates synthetic inputs across a range of sizes, column counts, link fan-outs,
+        with and without labels and images, and times ReadInput, MakeLeftRightPoints,
+        Draw and saving to each output format. Every case runs in a fresh process so its
+        peak memory is its own, with numpy and matplotlib imported before timing starts.
+        Results are written as JSON, see --help for the options.
+
+    python benchmark.py compare OLD.json NEW.json
+        Compares two suite results case by case, e.g. from two commits.
+
+    python benchmark.py draw [N_STATES ...]
+        Times drawing and saving synthetic diagrams of increasing size with the
+        default per-state Line2D path and the batched LineCollection path.
+
+    python benchmark.py parse [N_STATES ...]
+        Times ReadInput on synthetic input files of increasing size, against the
+        original line by line parser.
+
+    python benchmark.py parity [INPUT ...]
+        Checks the input parser reads example.inp, every key spelling the original
+        parser accepted and a synthetic input (or the given inputs) exactly as the
+        original parser did. Exits with status 1 on any difference.
+
+    python benchmark.py generate FILE N_STATES [options]
+        Writes a synthetic input file, e.g. to try out by hand.
+"""
+from __future__ import print_function
+import sys
+import os
+import time
+import random
+import tempfile
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import multiprocessing
+
+import EnergyLeveller as el
+
+COLORS = ["red", "#003399", "#009933", "black"]
+
+######################################################################################################
+#           Synthetic inputs
+######################################################################################################
+
+def MakeSyntheticStates(nStates, nColumns=20, fanout=2, labels=True, seed=0):
+    """
+    Makes nStates states spread over nColumns, each linked to up to
+    fanout states in the next column.
+    """
+    rng = random.Random(seed)
+    states = []
+    for i in range(nStates):
+        state = el.State()
+        state.name = "S{:}".format(i)
+        state.column = i % nColumns
+        state.energy = round(rng.uniform(-50.0, 50.0), 1)
+        state.color = COLORS[i % len(COLORS)]
+        state.labelColor = state.color
+        state.legend = "Path {:}".format(i % len(COLORS))
+        if labels:
+            state.label = "S$_{{{:}}}$".format(i)
+        else:
+            state.show_energy = False
+        states.append(state)
+
+    for i, state in enumerate(states):
+        links = []
+        for _ in range(fanout):
+            row = i // nColumns + rng.randint(-2, 2)
+            dest = row*nColumns + state.column + 1
+            if state.column + 1 < nColumns and 0 <= dest < nStates:
+                links.append(states[dest].name + ":" + state.color)
+        state.linksTo = ",".join(links)
+    return states
+
+def MakeSyntheticDiagram(nStates, outputName, nColumns=20, fanout=2, labels=False, seed=0):
+    diagram = el.Diagram(12, 8, 8, outputName, None)
+    for state in MakeSyntheticStates(nStates, nColumns, fanout, labels, seed):
+        diagram.AddState(state)
+    diagram.columns = nColumns
+    return diagram
+
+def WriteSyntheticImages(directory, count, size=400):
+    """
+    Writes count distinct size x size PNG images to directory, returning their paths.
+    """
+    el._ImportMatplotlib()
+    np = el.np
+    y, x = np.mgrid[0:size, 0:size]/float(size)
+    paths = []
+    for i in range(count):
+        image = np.dstack([
+            0.5 + 0.5*np.sin(x*(i + 3)*np.pi),
+            0.5 + 0.5*np.cos(y*(i + 2)*np.pi),
+            (x + y)/2.0])
+        path = os.path.join(directory, "structure{:}.png".format(i))
+        el.plt.imsave(path, image)
+        paths.append(path)
+    return paths
+
+def WriteSyntheticInput(filename, nStates, outputName="synthetic.pdf", nColumns=20, fanout=2,
+        labels=True, images=None, imageEvery=10, seed=0):
+    """
+    Writes a synthetic input file. When a list of image paths is given, every
+    imageEvery-th state shows one of them.
+    """
+    with open(filename, 'w') as out:
+        out.write("output-file = {:}\nwidth = 12\nheight = 8\nenergy-units = kJ/mol\n".format(outputName))
+        for i, state in enumerate(MakeSyntheticStates(nStates, nColumns, fanout, labels, seed)):
+            out.write("\n{\n")
+            out.write("    name        = {:}\n".format(state.name))
+            out.write("    text-colour = {:}\n".format(state.color))
+            out.write("    labelColour = {:}\n".format(state.labelColor))
+            out.write("    label       = {:}\n".format(state.label))
+            out.write("    energy      = {:}\n".format(state.energy))
+            out.write("    column      = {:}\n".format(state.column + 1))
+            out.write("    legend      = {:}\n".format(state.legend))
+            if state.linksTo != "":
+                out.write("    links to    = {:}\n".format(state.linksTo))
+            if not state.show_energy:
+                out.write("    hide energy\n")
+            if images and i % imageEvery == 0:
+                out.write("    image       = {:}\n".format(images[(i//imageEvery) % len(images)]))
+                out.write("    image scale = 1\n")
+            out.write("}\n")
+
+######################################################################################################
+#           Suite
+######################################################################################################
+
+def RunCase(case):
+    """
+    Generates the input for one suite case and times reading, layout, drawing and saving it.
+    Run in its own process, so the peak memory reported belongs to this case alone.
+    """
+    directory = tempfile.mkdtemp(prefix="energyleveller-bench-")
+    try:
+        images = None
+        if case["images"] > 0:
+            images = WriteSyntheticImages(directory, case["images"])
+        filename = os.path.join(directory, "bench.inp")
+        outputName = os.path.join(directory, "bench." + case["format"])
+        WriteSyntheticInput(filename, case["states"], outputName, case["columns"], case["fanout"],
+            case["labels"], images)
+
+        # Imported before timing starts, or the layout and draw columns of small cases
+        # would mostly measure loading numpy and matplotlib
+        el._ImportMatplotlib()
+        profiler = el.Profiler()
+        with open(os.devnull, 'w') as devnull, el.RedirectOutput(devnull):
+            diagram = el.ReadInput(filename, profiler=profiler)
+        diagram.useCollections = case["collections"]
+        diagram.fastLayout = case.get("fastLayout", False)
+        diagram.MakeLeftRightPoints()
+        diagram.Draw()
+        diagram.Close()
+
+        report = profiler.Report()
+        report["case"] = case
+        report["inputKB"] = os.path.getsize(filename)/1024.0
+        report["outputKB"] = os.path.getsize(diagram.outputName)/1024.0
+        return report
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+def CaseName(case):
+    return "{states}st-{columns}col-f{fanout}-{lab}-{images}img-{mode}{fast}.{format}".format(
+        lab="labels" if case["labels"] else "nolabels",
+        mode="collections" if case["collections"] else "lines",
+        fast="-fast" if case.get("fastLayout") else "", **case)
+
+def Environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    el._ImportMatplotlib()
+    return {
+        "commit":     commit,
+        "version":    el.VERSION,
+        "python":     platform.python_version(),
+        "matplotlib": el.matplotlib.__version__,
+        "numpy":      el.np.__version__,
+        "platform":   platform.platform(),
+        "time":       time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+def Suite(argv):
+    parser = argparse.ArgumentParser(prog="benchmark.py suite")
+    parser.add_argument("--states", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--columns", type=int, nargs="+", default=[20])
+    parser.add_argument("--fanout", type=int, nargs="+", default=[2])
+    parser.add_argument("--labels", choices=["on", "off", "both"], default="on")
+    parser.add_argument("--images", type=int, nargs="+", default=[0],
+        help="number of distinct images, each shown by every 10th state (default: 0).")
+    parser.add_argument("--formats", nargs="+", default=["pdf", "png", "svg"])
+    parser.add_argument("--collections", choices=["on", "off", "both"], default="both")
+    parser.add_argument("--fast-layout", choices=["on", "off", "both"], default="off")
+    parser.add_argument("--output", default="benchmark-results.json")
+    args = parser.parse_args(argv)
+
+    choices = {"on": [True], "off": [False], "both": [False, True]}
+    cases = []
+    for states, columns, fanout, labels, images, fmt, collections, fast in itertools.product(
+            args.states, args.columns, args.fanout, choices[args.labels], args.images,
+            args.formats, choices[args.collections], choices[args.fast_layout]):
+        cases.append({"states": states, "columns": columns, "fanout": fanout, "labels": labels,
+            "images": images, "format": fmt, "collections": collections, "fastLayout": fast})
+
+    print("{:<52} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "case", "read (s)", "layout", "draw", "save", "total", "peak MB"))
+    results = []
+    # A fresh process for every case, so each peak memory figure is that case's own
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for report in pool.imap(RunCase, cases):
+            phases = dict((p["name"], p["seconds"]) for p in report["phases"])
+            save = phases.get("tight_layout", 0.0) + phases.get("savefig", 0.0)
+            print("{:<52} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.1f}".format(
+                CaseName(report["case"]), phases.get("read", 0.0), phases.get("layout", 0.0),
+                phases.get("draw", 0.0), save, report["total"], report["peakMemoryMB"] or 0.0))
+            results.append(report)
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(args.output, 'w') as out:
+        json.dump({"environment": Environment(), "results": results}, out, indent=2)
+    print("Results written to " + args.output)
+
+def Compare(argv):
+    if len(argv) != 2:
+        print("Usage: python benchmark.py compare OLD.json NEW.json")
+        raise SystemExit(1)
+    runs = []
+    for filename in argv:
+        with open(filename) as f:
+            runs.append(json.load(f))
+    old = dict((CaseName(r["case"]), r) for r in runs[0]["results"])
+
+    print("old: {:}  new: {:}".format(runs[0]["environment"].get("commit"), runs[1]["environment"].get("commit")))
+    print("{:<52} {:>10} {:>10} {:>8} {:>10} {:>10}".format(
+        "case", "old (s)", "new (s)", "ratio", "old MB", "new MB"))
+    for report in runs[1]["results"]:
+        name = CaseName(report["case"])
+        if name not in old:
+            continue
+        before = old[name]
+        print("{:<52} {:>10.3f} {:>10.3f} {:>8.2f} {:>10.1f} {:>10.1f}".format(
+            name, before["total"], report["total"], report["total"]/before["total"],
+            before["peakMemoryMB"] or 0.0, report["peakMemoryMB"] or 0.0))
+
+def Generate(argv):
+    parser = argparse.ArgumentParser(prog="benchmark.py generate")
+    parser.add_argument("filename")
+    parser.add_argument("states", type=int)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--fanout", type=int, default=2)
+    parser.add_argument("--no-labels", action="store_true")
+    parser.add_argument("--images", type=int, default=0)
+    parser.add_argument("--output-file", default="synthetic.pdf")
+    args = parser.parse_args(argv)
+
+    images = None
+    if args.images > 0:
+        images = WriteSyntheticImages(os.path.dirname(os.path.abspath(args.filename)), args.images)
+    WriteSyntheticInput(args.filename, args.states, args.output_file, args.columns, args.fanout,
+        not args.no_labels, images)
+    print("Wrote " + args.filename)
+
+######################################################################################################
+#           Reference parser
+######################################################################################################
+
+def LegacyRead(lines):
+    """
+    The input parser as it was before the table driven InputParser, kept to check the
+    new one against and to time it. Returns (options, states). Images are only
+    recorded by path rather than decoded, and the font size is not applied.
+    """
+    statesList = []
+    stateBlock = False
+    options = {"width": 0, "height": 0, "fontSize": None, "energyUnits": "", "y_lims": None, "outputName": ""}
+    lc = 0
+    for line in lines:
+        lc += 1
+        line = line.strip()
+        if (len(line) > 0 and line.strip()[0] != "#"):
+            if (stateBlock):
+                if (line.strip()[0] == "{"):
+                    raise ValueError("ERROR: Unexpected { on line " + str(lc))
+                if (line.strip()[0] == "}"):
+                    stateBlock = False
+                else:
+                    raw = line.split('=')
+                    raw[0] = raw[0].upper().strip()
+                    try:
+                        raw[1] = raw[1].strip()
+                    except IndexError:
+                        pass
+                    state = statesList[-1]
+                    if (raw[0] == "NAME"):
+                        state.name = raw[1].upper()
+                    elif raw[0] in ("TEXTCOLOR", "TEXTCOLOUR", "TEXT-COLOUR", "TEXT-COLOR", "TEXT COLOUR", "TEXT COLOR"):
+                        state.color = raw[1]
+                    elif (raw[0] == "LABEL"):
+                        state.label = ""
+                        for i in range(1, len(raw)):
+                            state.label += raw[i]
+                            if i < len(raw)-1:
+                                state.label += " = "
+                    elif (raw[0] == "LABELCOLOR" or raw[0] == "LABELCOLOUR"):
+                        state.labelColor = raw[1]
+                    elif (raw[0] == "LINKSTO" or raw[0] == "LINKS TO"):
+                        state.linksTo = raw[1].upper()
+                    elif (raw[0] == "COLUMN"):
+                        try:
+                            state.column = int(raw[1])-1
+                        except ValueError:
+                            pass
+                    elif (raw[0] == "ENERGY"):
+                        try:
+                            state.energy = float(raw[-1])
+                        except ValueError:
+                            pass
+                    elif raw[0] in ("LABELOFFSET", "LABEL OFFSET", "LABEL-OFFSET", "TEXTOFFSET", "TEXT OFFSET", "TEXT-OFFSET") \
+                            or ("IMAGE" in raw[0] and "OFFSET" in raw[0]):
+                        raw[1] = raw[1].split(',')
+                        try:
+                            pair = (float(raw[1][0]), float(raw[1][1]))
+                        except ValueError:
+                            continue
+                        if raw[0].startswith("LABEL"):
+                            state.labelOffset = pair
+                        elif raw[0].startswith("TEXT"):
+                            state.textOffset = pair
+                        else:
+                            state.imageOffset = pair
+                    elif raw[0] == "LEGEND":
+                        state.legend = raw[1]
+                    elif raw[0] == "IMAGE":
+                        state.imagePath = raw[-1]
+                    elif "IMAGE" in raw[0] and "SCALE" in raw[0]:
+                        try:
+                            state.imageScale = max(float(raw[1]), 0.1)
+                        except ValueError:
+                            pass
+                    elif "HIDE" in raw[0] and "ENERGY" in raw[0]:
+                        state.show_energy = False
+            elif (line.strip()[0] == "{"):
+                statesList.append(el.State())
+                stateBlock = True
+            elif (line.strip()[0] != "}"):
+                raw = line.split('=')
+                if (len(raw) == 2):
+                    raw[0] = raw[0].upper().strip()
+                    raw[1] = raw[1].strip().lstrip()
+                    try:
+                        if (raw[0] == "WIDTH"):
+                            options["width"] = int(raw[1])
+                        elif (raw[0] == "HEIGHT"):
+                            options["height"] = int(raw[1])
+                        elif (raw[0] == "OUTPUT-FILE" or raw[0] == "OUTPUT"):
+                            options["outputName"] = raw[1] if raw[1].endswith('.pdf') else raw[1] + ".pdf"
+                        elif raw[0] in ("ENERGY-UNITS", "ENERGYUNITS", "ENERGY UNITS"):
+                            options["energyUnits"] = raw[1]
+                        elif raw[0] in ("FONT-SIZE", "FONTSIZE", "FONT SIZE"):
+                            options["fontSize"] = int(raw[1])
+                        elif "ENERGY" in raw[0] and "RANGE" in raw[0]:
+                            y_lims = [float(l) for l in raw[1].split(',')]
+                            if len(y_lims) == 2:
+                                options["y_lims"] = y_lims
+                    except ValueError:
+                        pass
+    for state in statesList:
+        state.name = state.name.upper()
+        state.linksTo = state.linksTo.upper()
+    return options, statesList
+
+# Every key spelling the original parser accepted, with values it handled specially
+ALIAS_INPUT = """
+output-file = aliases.pdf
+WIDTH = 8
+Height = 6
+energy-units = kJ/mol
+FONT SIZE = 12
+energy range = -5, 30
+{
+    NAME = a
+    TEXTCOLOR = red
+    LABELCOLOR = blue
+    LABEL = $x = y$ = z
+    ENERGY = 1 = 2.5
+    COLUMN = 2
+    LINKS TO = b:red, c
+    LABEL OFFSET = 0.5, 1
+    TEXT-OFFSET = 0, -1
+    LEGEND = Path A
+}
+{
+    name = b
+    Text-Colour = #003399
+    labelcolour = green
+    textoffset = 1,2
+    label-offset = 3,4
+    linksto = c:blue,
+    energy = -3.25
+    hide energy
+}
+{
+    name = c
+    text colour = black
+    Text Color = gray
+    text-color = k
+    TEXT COLOUR = k
+    TEXTCOLOUR = k
+    labeloffset = 0,0
+    text offset = 0.1,0.2
+    image = {image}
+    image-offset = 1,1
+    image scale = 0.05
+    image_scale = 2
+}
+"""
+
+def ParserParity(argv):
+    """
+    Reads each input with ReadString() and LegacyRead(), reporting any state or option
+    that differs. Returns the number of inputs that differ.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    inputs = []
+    for filename in argv or [os.path.join(here, "example.inp")]:
+        with open(filename) as f:
+            inputs.append((filename, f.read()))
+    if len(argv) == 0:
+        inputs.append(("aliases", ALIAS_INPUT.replace("{image}", os.path.join(here, "ch3o.png"))))
+        handle, synthetic = tempfile.mkstemp(suffix=".inp")
+        os.close(handle)
+        try:
+            WriteSyntheticInput(synthetic, 2000, labels=True)
+            with open(synthetic) as f:
+                inputs.append(("synthetic 2000 states", f.read()))
+        finally:
+            os.remove(synthetic)
+
+    failed = 0
+    for name, text in inputs:
+        options, legacy = LegacyRead(text.splitlines())
+        diagram = el.ReadString(text, loadImages=False)
+        problems = []
+        for key in sorted(options):
+            value = getattr(diagram, key)
+            if value != options[key]:
+                problems.append("{:}: {!r} != {!r}".format(key, value, options[key]))
+        states = diagram.layout.states
+        if len(states) != len(legacy):
+            problems.append("{:} states != {:}".format(len(states), len(legacy)))
+        for new, old in zip(states, legacy):
+            if new.Fingerprint() != old.Fingerprint() or new.imagePath != old.imagePath:
+                problems.append("state {:}: {!r} != {!r}".format(new.name, new.Fingerprint(), old.Fingerprint()))
+        print("  [{:}] {:} ({:} states)".format("OK" if len(problems) == 0 else "DIFF", name, len(legacy)))
+        for problem in problems:
+            print("      " + problem)
+        failed += len(problems) > 0
+    return failed
+
+######################################################################################################
+#           Quick comparisons
+######################################################################################################
+
+def TimeDraw(nStates, useCollections, outputName):
+    diagram = MakeSyntheticDiagram(nStates, outputName)
+    diagram.useCollections = useCollections
+    start = time.time()
+    diagram.MakeLeftRightPoints()
+    diagram.Draw()
+    elapsed = time.time() - start
+    diagram.Close()
+    return elapsed, os.path.getsize(outputName)
+
+def TimeParse(nStates, filename):
+    """
+    Returns the seconds taken by ReadInput and by the original parser, and the file size.
+    """
+    WriteSyntheticInput(filename, nStates, labels=False)
+    start = time.time()
+    el.ReadInput(filename)
+    elapsed = time.time() - start
+    start = time.time()
+    with open(filename) as f:
+        _, states = LegacyRead(f)
+    diagram = el.Diagram(0, 0, None, "", None)
+    for state in states:
+        diagram.AddState(state)
+    diagram.CheckLinks()
+    return elapsed, time.time() - start, os.path.getsize(filename)
+
+def BenchmarkDraw(sizes, outDir):
+    outputName = os.path.join(outDir, "bench.pdf")
+    print("{:>8} {:>12} {:>12} {:>9} {:>12} {:>12}".format(
+        "states", "lines (s)", "collect (s)", "speedup", "lines (kB)", "collect (kB)"))
+    for n in sizes:
+        lines, linesSize = TimeDraw(n, False, outputName)
+        collect, collectSize = TimeDraw(n, True, outputName)
+        print("{:>8} {:>12.3f} {:>12.3f} {:>9.1f} {:>12.1f} {:>12.1f}".format(
+            n, lines, collect, lines/collect, linesSize/1024.0, collectSize/1024.0))
+    os.remove(outputName)
+
+def BenchmarkParse(sizes, outDir):
+    filename = os.path.join(outDir, "bench.inp")
+    print("{:>8} {:>12} {:>12} {:>12} {:>9} {:>14}".format(
+        "states", "input (kB)", "parse (s)", "original (s)", "speedup", "states/s"))
+    for n in sizes:
+        elapsed, original, size = TimeParse(n, filename)
+        print("{:>8} {:>12.1f} {:>12.3f} {:>12.3f} {:>9.1f} {:>14.0f}".format(
+            n, size/1024.0, elapsed, original, original/elapsed, n/elapsed))
+    os.remove(filename)
+
+QUICK_BENCHMARKS = {
+    "draw":  (BenchmarkDraw, [100, 1000, 5000, 10000]),
+    "parse": (BenchmarkParse, [1000, 10000, 100000]),
+}
+
+def Quick(name, argv):
+    benchmark, sizes = QUICK_BENCHMARKS[name]
+    sizes = [int(a) for a in argv] or sizes
+    outDir = tempfile.mkdtemp(prefix="energyleveller-bench-")
+    try:
+        benchmark(sizes, outDir)
+    finally:
+        os.rmdir(outDir)
+
+def main():
+    commands = ["suite", "compare", "generate", "parity"] + sorted(QUICK_BENCHMARKS)
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print("Usage: python benchmark.py {" + "|".join(commands) + "} ...")
+        raise SystemExit(1)
+    command = sys.argv[1]
+    if command == "suite":
+        Suite(sys.argv[2:])
+    elif command == "compare":
+        Compare(sys.argv[2:])
+    elif command == "generate":
+        Generate(sys.argv[2:])
+    elif command == "parity":
+        if ParserParity(sys.argv[2:]) > 0:
+            raise SystemExit(1)
+    else:
+        Quick(command, sys.argv[2:])
+
+if __name__ == "__main__":
+    main()